@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# hashbench - measure how fast pyfedpkg hashes source files
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+# Compares the old way of hashing (8 KiB reads, one full read per hash
+# type) against _hash_file_digests, which reads the file once for all the
+# hash types.  Run it from the top of the source tree:
+#
+#   python bench/hashbench.py --size 512 --hash md5 --hash sha512
+#
+# The file is read once before timing, so the numbers are for a warm page
+# cache unless you drop the caches yourself between runs.
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import pyfedpkg
+
+def old_hash_file(file, hashtype):
+    """The _hash_file we used to have, kept here to compare against"""
+
+    sum = hashlib.new(hashtype)
+    input = open(file, 'rb')
+    while True:
+        chunk = input.read(8192)
+        if not chunk:
+            break
+        sum.update(chunk)
+    input.close()
+    return sum.hexdigest()
+
+def old_hash_all(file, hashtypes):
+    """Hash a file the old way, one read per hash type"""
+
+    digests = {}
+    for hashtype in hashtypes:
+        digests[hashtype] = old_hash_file(file, hashtype)
+    return digests
+
+def best_time(function, repeat):
+    """Return the fastest of several runs of function and its result"""
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark source hashing')
+    parser.add_argument('--size', type = int, default = 256,
+                        help = 'Size of the test file in MiB')
+    parser.add_argument('--hash', action = 'append', dest = 'hashtypes',
+                        help = 'Hash type to compute, may be repeated')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'Runs of each implementation, best is kept')
+    parser.add_argument('--file', help = 'Hash this file instead of a '
+                                         'generated one')
+    args = parser.parse_args()
+    hashtypes = args.hashtypes or ['md5', 'sha512']
+
+    tmpfile = None
+    if args.file:
+        testfile = args.file
+    else:
+        (fd, tmpfile) = tempfile.mkstemp(prefix='hashbench.')
+        output = os.fdopen(fd, 'wb')
+        block = os.urandom(1024 * 1024)
+        for i in range(args.size):
+            output.write(block)
+        output.close()
+        testfile = tmpfile
+    size = os.path.getsize(testfile) / (1024.0 * 1024.0)
+
+    try:
+        # Warm the page cache so both sides start the same
+        old_hash_file(testfile, 'md5')
+        oldtime, olddigests = best_time(lambda: old_hash_all(testfile,
+                                                             hashtypes),
+                                        args.repeat)
+        newtime, newdigests = best_time(
+                lambda: pyfedpkg._hash_file_digests(testfile, hashtypes),
+                args.repeat)
+    finally:
+        if tmpfile:
+            os.remove(tmpfile)
+
+    if olddigests != newdigests:
+        print('Digests do not match!')
+        sys.exit(1)
+    print('%.0f MiB, hashes: %s' % (size, ', '.join(hashtypes)))
+    print('old _hash_file:      %8.1f MB/s  (%.2fs)' % (size / oldtime,
+                                                        oldtime))
+    print('_hash_file_digests:  %8.1f MB/s  (%.2fs)' % (size / newtime,
+                                                        newtime))
+    print('speedup:             %8.2fx' % (oldtime / newtime))
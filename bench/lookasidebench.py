@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# lookasidebench - time the pyfedpkg source transfer code against a local
+# stand-in for the lookaside cache
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+# Starts a local HTTP server that serves files in the lookaside layout
+# (module/file/checksum/file) and answers like upload.cgi does, then times
+# PackageModule.upload(), Lookaside.file_exists(), Lookaside.files_exist()
+# and PackageModule.sources() on generated modules.  Run it from the top of
+# the source tree on a machine with the rpm, koji and git python bindings:
+#
+#   python bench/lookasidebench.py --scenario 1x64M --scenario 20x1M \
+#       --latency 50 --output results.csv
+#
+# Each scenario is COUNTxSIZE, where SIZE takes a K, M or G suffix.
+# --latency adds a delay, in milliseconds, before every response to stand
+# in for a far away server.  With --output the results are appended to a
+# CSV file together with the date and git revision so runs can be compared
+# over time.
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import pyfedpkg
+
+# Where the server pretends the lookaside lives
+PREFIX = '/repo/pkgs'
+MODULE = 'benchpkg'
+SPEC = """Name:           %s
+Version:        1.0
+Release:        1%%{?dist}
+Summary:        Package for benchmarking the lookaside code
+Group:          Development/Tools
+License:        GPLv2+
+
+%%description
+Package for benchmarking the lookaside code.
+
+%%files
+""" % MODULE
+
+class LookasideServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, address, LookasideHandler)
+        self.root = root
+        self.latency = latency
+
+class LookasideHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open so connection reuse shows up in the numbers
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = urllib.unquote(self.path.split('?')[0])
+        if not path.startswith(PREFIX + '/'):
+            return self._reply(404, 'Not Found\n')
+        local = os.path.join(self.server.root, path[len(PREFIX) + 1:])
+        if not os.path.isfile(local):
+            return self._reply(404, 'Not Found\n')
+        size = os.path.getsize(local)
+        start = 0
+        code = 200
+        headers = {}
+        range = self.headers.get('Range')
+        if range and range.startswith('bytes=') and range.endswith('-'):
+            start = int(range[len('bytes='):-1])
+            if start >= size:
+                return self._reply(416, 'Requested Range Not Satisfiable\n')
+            code = 206
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (start, size - 1,
+                                                           size)
+        self.send_response(code)
+        self.send_header('Content-Length', str(size - start))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        input = open(local, 'rb')
+        input.seek(start)
+        shutil.copyfileobj(input, self.wfile, 1024 * 1024)
+        input.close()
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            # curl holds back a big body for a second waiting for this
+            self.wfile.write('%s 100 Continue\r\n\r\n' %
+                             self.protocol_version)
+            self.wfile.flush()
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        name = form.getvalue('name')
+        md5sum = form.getvalue('md5sum')
+        if not name or not md5sum:
+            return self._reply(500, 'Required field missing\n')
+        if 'file' not in form:
+            # Just checking if the file is there
+            filename = form.getvalue('filename')
+            path = os.path.join(self.server.root, name, filename, md5sum,
+                                filename)
+            if os.path.exists(path):
+                return self._reply(200, 'Available\n')
+            return self._reply(200, 'Missing\n')
+        upload = form['file']
+        filename = os.path.basename(upload.filename)
+        dest = os.path.join(self.server.root, name, filename, md5sum)
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        (fd, tmpfile) = tempfile.mkstemp(dir=dest)
+        output = os.fdopen(fd, 'wb')
+        sum = hashlib.md5()
+        while True:
+            chunk = upload.file.read(1024 * 1024)
+            if not chunk:
+                break
+            sum.update(chunk)
+            output.write(chunk)
+        output.close()
+        if sum.hexdigest() != md5sum:
+            os.remove(tmpfile)
+            return self._reply(500, 'MD5 check failed\n')
+        os.rename(tmpfile, os.path.join(dest, filename))
+        self._reply(200, 'Stored %s\n' % filename)
+
+def serve(root, latency, pipe):
+    """Run the server, sending the port it got back through pipe"""
+
+    server = LookasideServer(('127.0.0.1', 0), root, latency)
+    pipe.send(server.server_address[1])
+    server.serve_forever()
+
+def parse_size(text):
+    """Turn 4M and friends into bytes"""
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+def make_module(path, count, size):
+    """Create a module checkout with count source files of size bytes"""
+
+    os.makedirs(path)
+    spec = open(os.path.join(path, '%s.spec' % MODULE), 'w')
+    spec.write(SPEC)
+    spec.close()
+    open(os.path.join(path, 'sources'), 'w').close()
+    subprocess.check_call(['git', 'init', '-q', path])
+    files = []
+    for i in range(count):
+        filename = os.path.join(path, '%s-%03d.tar.gz' % (MODULE, i))
+        output = open(filename, 'wb')
+        left = size
+        while left > 0:
+            chunk = os.urandom(min(left, 1024 * 1024))
+            output.write(chunk)
+            left -= len(chunk)
+        output.close()
+        files.append(filename)
+    return files
+
+def timed(function):
+    """Return how long function took to run"""
+
+    start = time.time()
+    function()
+    return time.time() - start
+
+def run_scenario(workdir, lookaside, scenario):
+    """Time all the operations for one scenario, returns a list of results
+
+    Each result is a tuple of operation, seconds and bytes moved.
+
+    """
+
+    count, size = scenario.split('x')
+    count = int(count)
+    size = parse_size(size)
+    path = os.path.join(workdir, 'module-%s' % scenario)
+    files = make_module(path, count, size)
+    total = count * size
+
+    mymodule = pyfedpkg.PackageModule(path)
+    mymodule.lookaside = 'http://%s%s' % (lookaside, PREFIX)
+    mymodule.lookaside_cgi = 'http://%s%s/upload.cgi' % (lookaside, PREFIX)
+    # Keep the user's real caches out of this
+    mymodule.cache = pyfedpkg.SourceCache(os.path.join(path, '.cache'))
+    mymodule.verifyindex = pyfedpkg.VerifyIndex(os.path.join(path, '.verified'))
+    results = []
+
+    results.append(('upload (all new)', timed(lambda:
+                    mymodule.upload(files, replace=True)), total))
+    results.append(('upload (all present)', timed(lambda:
+                    mymodule.upload(files, replace=True)), 0))
+
+    sums = [pyfedpkg._hash_file(f, mymodule.lookasidehash) for f in files]
+    checks = [(MODULE, os.path.basename(f), sum) for (f, sum) in
+              zip(files, sums)]
+    look = pyfedpkg.Lookaside(mymodule.lookaside_cgi)
+    results.append(('file_exists (each)', timed(lambda:
+                    [look.file_exists(*check) for check in checks]), 0))
+    results.append(('files_exist (batch)', timed(lambda:
+                    look.files_exist(checks)), 0))
+    look.close()
+
+    def cold_sources():
+        for f in files:
+            os.remove(f)
+        shutil.rmtree(mymodule.cache.path, ignore_errors=True)
+        mymodule.verifyindex = pyfedpkg.VerifyIndex(os.path.join(path,
+                                                    '.verified-cold'))
+        start = time.time()
+        mymodule.sources()
+        return time.time() - start
+
+    results.append(('sources (download)', cold_sources(), total))
+    results.append(('sources (present)', timed(mymodule.sources), 0))
+    return results
+
+def git_revision():
+    """Return the revision of the tree we are benchmarking, if we can"""
+
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.communicate()[0].strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description = 'Benchmark the lookaside transfer code')
+    parser.add_argument('--scenario', action = 'append', dest = 'scenarios',
+                        help = 'COUNTxSIZE of source files, may be repeated')
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'Delay before every response in ms')
+    parser.add_argument('--output', help = 'Append results to this CSV file')
+    parser.add_argument('--keep', action = 'store_true',
+                        help = 'Keep the work directory for inspection')
+    args = parser.parse_args()
+    scenarios = args.scenarios or ['1x64M', '10x4M', '50x256K']
+
+    workdir = tempfile.mkdtemp(prefix='lookasidebench.')
+    root = os.path.join(workdir, 'lookaside')
+    os.makedirs(root)
+    (ours, theirs) = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+                                     args=(root, args.latency / 1000.0,
+                                           theirs))
+    server.daemon = True
+    server.start()
+    lookaside = '127.0.0.1:%s' % ours.recv()
+
+    revision = git_revision()
+    date = time.strftime('%Y-%m-%dT%H:%M:%S')
+    rows = []
+    try:
+        for scenario in scenarios:
+            for operation, seconds, size in run_scenario(workdir, lookaside,
+                                                         scenario):
+                rows.append((scenario, operation, seconds, size))
+    finally:
+        server.terminate()
+        if args.keep:
+            print('Work directory left in %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print('revision %s, latency %sms' % (revision, args.latency))
+    print('%-10s %-22s %10s %10s' % ('scenario', 'operation', 'seconds',
+                                     'MB/s'))
+    for scenario, operation, seconds, size in rows:
+        rate = '-'
+        if size and seconds:
+            rate = '%.1f' % (size / seconds / (1024 * 1024))
+        print('%-10s %-22s %10.3f %10s' % (scenario, operation, seconds,
+                                           rate))
+    if args.output:
+        new = not os.path.exists(args.output)
+        output = open(args.output, 'a')
+        if new:
+            output.write('date,revision,latency_ms,scenario,operation,'
+                         'seconds,bytes\n')
+        for scenario, operation, seconds, size in rows:
+            output.write('%s,%s,%s,%s,%s,%.4f,%s\n' % (date, revision,
+                         args.latency, scenario, operation, seconds, size))
+        output.close()
@@ -300,11 +300,14 @@ def build(args):
     # Need to do something with BUILD_FLAGS or KOJI_FLAGS here for compat
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        # The module works these out when first asked, so ask here where
+        # we can report the problems
+        kojiconfig = _get_secondary_config(mymodule)
+        mymodule.repo
     except pyfedpkg.FedpkgError, e:
         # This error needs a better print out
         log.error('Could not use module: %s' % e)
         sys.exit(1)
-    kojiconfig = _get_secondary_config(mymodule)
     try:
         mymodule.init_koji(args.user, kojiconfig)
     except pyfedpkg.FedpkgError, e:
@@ -337,20 +340,53 @@ def build(args):
     # pass info off to our koji task watcher
     return _watch_koji_tasks(mymodule.kojisession, [task_id], quiet=args.q)
 
+def cache(args):
+    mycache = pyfedpkg.SourceCache()
+    if args.max_size is not None:
+        mycache.maxsize = args.max_size * 1024 * 1024
+    try:
+        if args.prune:
+            removed, freed = mycache.prune()
+            log.info('Removed %s files, freed %s' % (removed,
+                                                     _format_size(freed)))
+        entries = mycache.entries()
+    except (OSError, IOError), e:
+        log.error('Could not read the source cache: %s' % e)
+        sys.exit(1)
+    if args.list:
+        for (lastused, size, hashtype, csum, path) in entries:
+            print('%s  %s  %10s  %s' % (time.strftime('%Y-%m-%d %H:%M',
+                                         time.localtime(lastused)),
+                                         csum, _format_size(size),
+                                         os.path.basename(path)))
+    print('%s: %s files, %s used of %s' % (mycache.path, len(entries),
+                                          _format_size(sum([entry[1] for entry
+                                                            in entries])),
+                                          _format_size(mycache.maxsize)))
+
 def chainbuild(args):
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        # make sure we don't try to chain ourself
+        if mymodule.module in args.package:
+            log.error('%s must not be in the chain' % mymodule.module)
+            sys.exit(1)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not use module %s' % e)
         sys.exit(1)
-    # make sure we don't try to chain ourself
-    if mymodule.module in args.package:
-        log.error('%s must not be in the chain' % mymodule.module)
+    # Find the latest commit of every component at once
+    log.debug('Processing chain %s' % ' '.join(args.package))
+    (heads, failed) = pyfedpkg.get_latest_commits([component for component
+                                                   in args.package
+                                                   if component != ':'])
+    if failed:
+        for component, e in failed:
+            log.error('Could not get a build url for %s: %s'
+                      % (component, e))
         sys.exit(1)
     # Break the chain up into sections
     urls = []
     build_set = []
-    log.debug('Processing chain %s' % ' '.join(args.package))
     for component in args.package:
         if component == ':':
             if build_set:
@@ -361,15 +397,9 @@ def chainbuild(args):
                 build_set = []
         else:
             # Figure out the scm url to build from package name
-            try:
-                hash = pyfedpkg.get_latest_commit(component)
-                url = pyfedpkg.ANONGITURL % {'module':
-                                             component} + '#%s' % hash
-                build_set.append(url)
-            except pyfedpkg.FedpkgError, e:
-                log.error('Could not get a build url for %s: %s'
-                          % (component, e))
-                sys.exit(1)
+            url = pyfedpkg.ANONGITURL % {'module':
+                                         component} + '#%s' % heads[component]
+            build_set.append(url)
     # Take care of the last build set if we have one
     if build_set:
         log.debug('Created a build set: %s' % ' '.join(build_set))
@@ -414,11 +444,36 @@ def clone(args):
         except:
             log.debug('Could not read Fedora cert, using login name')
             args.user = os.getlogin()
+    modules = list(args.module)
+    if args.file:
+        try:
+            for line in open(args.file, 'r').readlines():
+                line = line.split('#')[0].strip()
+                if line:
+                    modules.append(line)
+        except IOError, e:
+            log.error('Could not read the module list: %s' % e)
+            sys.exit(1)
+    if not modules:
+        log.error('Could not clone: no modules given')
+        sys.exit(1)
     try:
-        if args.branches:
-            pyfedpkg.clone_with_dirs(args.module[0], args.user)
+        if len(modules) > 1:
+            failed = pyfedpkg.clone_modules(modules, args.user, args.path,
+                                            args.branch, args.reference,
+                                            dirs=args.branches)
+            if failed:
+                log.error('Could not clone %s of %s modules:' %
+                          (len(failed), len(modules)))
+                for module, error in failed:
+                    log.error('  %s: %s' % (module, error))
+                sys.exit(1)
+        elif args.branches:
+            pyfedpkg.clone_with_dirs(modules[0], args.user, args.path,
+                                     reference=args.reference)
         else:
-            pyfedpkg.clone(args.module[0], args.user, args.path, args.branch)
+            pyfedpkg.clone(modules[0], args.user, args.path, args.branch,
+                           reference=args.reference)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not clone: %s' % e)
         sys.exit(1)
@@ -436,13 +491,14 @@ def commit(args):
 
 def compile(args):
     arch = None
-    short = False
     if args.arch:
         arch = args.arch
-    if args.short_circuit:
-        short = True
+    # None lets the module work out if short-circuiting is safe
+    short = args.short_circuit
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        mymodule.paranoid = args.paranoid
+        mymodule.ccache = args.ccache or mymodule.ccache
         return mymodule.compile(arch=arch, short=short)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not compile: %s' % e)
@@ -474,13 +530,20 @@ def import_srpm(args):
         log.warning('Not implimented yet.')
         sys.exit(0)
     if not args.create:
+        # Figure out if we want a verbose output or not
+        callback = None
+        if not args.q:
+            callback = _progress_callback
         try:
             uploadfiles = pyfedpkg.import_srpm(args.srpm, path=args.path)
             mymodule = pyfedpkg.PackageModule(args.path)
-            mymodule.upload(uploadfiles, replace=True)
+            mymodule.upload(uploadfiles, replace=True, callback=callback)
         except pyfedpkg.FedpkgError, e:
             log.error('Could not import srpm: %s' % e)
             sys.exit(1)
+        if callback:
+            # print an extra blank line due to callback oddity
+            print('')
         # replace this system call with a proper diff target when it is
         # readys
         mymodule.diff(cached=True)
@@ -491,13 +554,14 @@ def import_srpm(args):
 
 def install(args):
     arch = None
-    short = False
     if args.arch:
         arch = args.arch
-    if args.short_circuit:
-        short = True
+    # None lets the module work out if short-circuiting is safe
+    short = args.short_circuit
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        mymodule.paranoid = args.paranoid
+        mymodule.ccache = args.ccache or mymodule.ccache
         return mymodule.install(arch=arch, short=short)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not install: %s' % e)
@@ -512,18 +576,61 @@ def lint(args):
         sys.exit(1)
 
 def local(args):
-    arch = None
-    if args.arch:
-        arch = args.arch
+    hashtype = 'sha256'
+    if args.md5:
+        hashtype = 'md5'
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
-        if args.md5:
-            return mymodule.local(arch=arch, hashtype='md5')
-        else:
-            return mymodule.local(arch=arch)
+        mymodule.paranoid = args.paranoid
+        mymodule.ccache = args.ccache or mymodule.ccache
+        if not args.all_arches and (not args.arch or len(args.arch) == 1):
+            arch = None
+            if args.arch:
+                arch = args.arch[0]
+            return mymodule.local(arch=arch, hashtype=hashtype)
+        results = mymodule.local_arches(arches=args.arch, hashtype=hashtype)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not build locally: %s' % e)
         sys.exit(1)
+    failed = False
+    for arch, returncode, logfile in results:
+        if returncode:
+            failed = True
+            log.info('%-8s failed (%s), see %s' % (arch, returncode, logfile))
+        else:
+            log.info('%-8s built in %s, see %s' %
+                     (arch, os.path.join(mymodule.path, '.build-%s' % arch),
+                      logfile))
+    if failed:
+        sys.exit(1)
+
+def _mock_status_table(out=sys.stdout):
+    """Return a mockbuild_configs callback that keeps a status table
+
+    On a tty the table is redrawn in place, otherwise a line is written
+    whenever a config changes state.
+
+    """
+
+    shown = {'lines': 0, 'states': {}}
+
+    def callback(status):
+        if out.isatty():
+            if shown['lines']:
+                # Go back up to the top of the table
+                out.write('\033[%dA' % shown['lines'])
+            for config, state, seconds in status:
+                out.write('%-32s %-9s %s\033[K\n' % (config, state,
+                                                     _format_secs(seconds)))
+            shown['lines'] = len(status)
+        else:
+            for config, state, seconds in status:
+                if shown['states'].get(config) != state:
+                    out.write('%-32s %-9s %s\n' % (config, state,
+                                                   _format_secs(seconds)))
+                    shown['states'][config] = state
+        out.flush()
+    return callback
 
 def mockbuild(args):
     # Pick up any mockargs from the env
@@ -535,10 +642,22 @@ def mockbuild(args):
         pass
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
-        return mymodule.mockbuild(mockargs)
+        if not args.config and not args.all_branches:
+            return mymodule.mockbuild(mockargs)
+        results = mymodule.mockbuild_configs(args.config, mockargs,
+                                             callback=_mock_status_table())
     except pyfedpkg.FedpkgError, e:
         log.error('Could not run mockbuild: %s' % e)
         sys.exit(1)
+    failed = False
+    for config, returncode, resultdir in results:
+        if returncode:
+            failed = True
+            log.error('%s failed, see %s' % (config, resultdir))
+        else:
+            log.info('%s built in %s' % (config, resultdir))
+    if failed:
+        sys.exit(1)
 
 def new(args):
     try:
@@ -548,12 +667,19 @@ def new(args):
         sys.exit(1)
 
 def new_sources(args):
+    # Figure out if we want a verbose output or not
+    callback = None
+    if not args.q:
+        callback = _progress_callback
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
-        mymodule.upload(args.files, replace=args.replace)
+        mymodule.upload(args.files, replace=args.replace, callback=callback)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not upload new sources: %s' % e)
         sys.exit(1)
+    if callback:
+        # print an extra blank line due to callback oddity
+        print('')
     print("Source upload succeeded. Don't forget to commit the sources file")
 
 def patch(args):
@@ -566,6 +692,7 @@ def prep(args):
         arch = args.arch
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        mymodule.paranoid = args.paranoid
         return mymodule.prep(arch=arch)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not prep: %s' % e)
@@ -578,16 +705,45 @@ def scratchbuild(args):
     build(args)
 
 def sources(args):
+    # Figure out if we want a verbose output or not
+    callback = None
+    if not args.q:
+        callback = _progress_callback
+    if args.tree:
+        return sources_tree(args, callback)
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
-        mymodule.sources(args.outdir)
+        mymodule.paranoid = args.paranoid
+        mymodule.sources(args.outdir, callback=callback)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not download sources: %s' % e)
         sys.exit(1)
+    if callback:
+        # print an extra blank line due to callback oddity
+        print('')
+
+def sources_tree(args, callback):
+    try:
+        checkouts, downloaded, reused, failed = \
+            pyfedpkg.prefetch_sources(args.path, callback=callback)
+    except pyfedpkg.FedpkgError, e:
+        log.error('Could not download sources: %s' % e)
+        sys.exit(1)
+    if callback:
+        # print an extra blank line due to callback oddity
+        print('')
+    for outfile, error in failed:
+        log.error('%s: %s' % (outfile, error))
+    log.info('%s checkouts: downloaded %s, reused %s, %s failed' %
+             (checkouts, _format_size(downloaded), _format_size(reused),
+              len(failed)))
+    if failed:
+        sys.exit(1)
 
 def srpm(args):
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        mymodule.paranoid = args.paranoid
         mymodule.sources(args.path)
         if args.md5:
             mymodule.srpm('md5')
@@ -621,10 +777,10 @@ def update(args):
 def verrel(args):
     try:
         mymodule = pyfedpkg.PackageModule(args.path)
+        print('%s-%s-%s' % (mymodule.module, mymodule.ver, mymodule.rel))
     except pyfedpkg.FedpkgError, e:
         log.error('Could not get ver-rel: %s' % e)
         sys.exit(1)
-    print('%s-%s-%s' % (mymodule.module, mymodule.ver, mymodule.rel))
 
 # THe main code goes here
 if __name__ == '__main__':
@@ -642,6 +798,13 @@ if __name__ == '__main__':
                         help = 'Run with verbose debug output')
     parser.add_argument('-q', action = 'store_true',
                         help = 'Run quietly only displaying errors')
+    # Don't trust previously recorded source file hashes
+    parser.add_argument('--paranoid', action = 'store_true',
+                        help = 'Hash all source files again even if they'
+                               ' have not changed')
+    # Build with a compiler cache
+    parser.add_argument('--ccache', action = 'store_true',
+                        help = 'Use a compiler cache for local builds')
 
     # Add a subparsers object to use for the actions
     subparsers = parser.add_subparsers(title = 'Targets')
@@ -682,6 +845,18 @@ if __name__ == '__main__':
                               help = 'Perform a scratch build')
     parser_build.set_defaults(command = build)
 
+    # Look after the shared source cache
+    parser_cache = subparsers.add_parser('cache',
+                    help = 'Show or prune the shared source file cache')
+    parser_cache.add_argument('--list', '-l', action = 'store_true',
+                              help = 'List the cached files, oldest first')
+    parser_cache.add_argument('--prune', action = 'store_true',
+                              help = 'Remove least recently used files until'
+                                     ' the cache fits its size limit')
+    parser_cache.add_argument('--max-size', type = int, default = None,
+                              help = 'Size limit to use in MiB')
+    parser_cache.set_defaults(command = cache)
+
     # chain build
     parser_chainbuild = subparsers.add_parser('chain-build',
                 help = 'Build current package in order with other packages',
@@ -731,9 +906,16 @@ packages will be built sequentially.
     # provide a convenient way to get to a specific branch
     parser_clone.add_argument('--branch', '-b',
                               help = 'Check out a specific branch')
-    # store the module to be cloned
-    parser_clone.add_argument('module', nargs = 1,
-                              help = 'Name of the module to clone')
+    # Borrow objects from a local repo instead of fetching them all
+    parser_clone.add_argument('--reference',
+                              help = 'Local repo to share objects with')
+    # Clone a whole list of modules
+    parser_clone.add_argument('--file', '-f',
+                              help = 'File listing modules to clone, one '
+                              'per line')
+    # store the module(s) to be cloned
+    parser_clone.add_argument('module', nargs = '*',
+                              help = 'Name of the module(s) to clone')
     parser_clone.set_defaults(command = clone)
 
     parser_co = subparsers.add_parser('co', parents = [parser_clone],
@@ -766,7 +948,13 @@ packages will be built sequentially.
                                         help = 'Local test rpmbuild compile')
     parser_compile.add_argument('--arch', help = 'Arch to compile for')
     parser_compile.add_argument('--short-circuit', action = 'store_true',
-                                help = 'short-circuit compile')
+                                default = None,
+                                help = 'short-circuit compile, by default '
+                                'only done when the earlier stages are '
+                                'current')
+    parser_compile.add_argument('--no-short-circuit', action = 'store_false',
+                                dest = 'short_circuit', default = None,
+                                help = 'Run every stage from %%prep on')
     parser_compile.set_defaults(command = compile)
 
     # export the module; not planned
@@ -808,7 +996,13 @@ packages will be built sequentially.
                                         help = 'Local test rpmbuild install')
     parser_install.add_argument('--arch', help = 'Arch to install for')
     parser_install.add_argument('--short-circuit', action = 'store_true',
-                                help = 'short-circuit install')
+                                default = None,
+                                help = 'short-circuit install, by default '
+                                'only done when the earlier stages are '
+                                'current')
+    parser_install.add_argument('--no-short-circuit', action = 'store_false',
+                                dest = 'short_circuit', default = None,
+                                help = 'Run every stage from %%prep on')
     parser_install.set_defaults(command = install)
 
     # rpmlint target
@@ -819,7 +1013,12 @@ packages will be built sequentially.
     # Build locally
     parser_local = subparsers.add_parser('local',
                                          help = 'Local test rpmbuild binary')
-    parser_local.add_argument('--arch', help = 'Build for arch')
+    parser_local.add_argument('--arch', action = 'append',
+                              help = 'Build for arch, may be repeated to '
+                              'build for several arches at once')
+    parser_local.add_argument('--all-arches', action = 'store_true',
+                              help = 'Build for every arch the package '
+                              'allows that can be built here')
     # optionally define old style hashsums
     parser_local.add_argument('--md5', action = 'store_true',
                               help = 'Use md5 checksums (for older rpm hosts)')
@@ -828,6 +1027,12 @@ packages will be built sequentially.
     # Build in mock
     parser_mockbuild = subparsers.add_parser('mockbuild',
                                         help = 'Local test build using mock')
+    parser_mockbuild.add_argument('--config', action = 'append',
+                                  help = 'Mock config to build with, may be '
+                                  'repeated to build with several at once')
+    parser_mockbuild.add_argument('--all-branches', action = 'store_true',
+                                  help = 'Build with the mock config of '
+                                  'every branch of the module')
     parser_mockbuild.set_defaults(command = mockbuild)
 
     # See what's different
@@ -870,6 +1075,9 @@ packages will be built sequentially.
     parser_sources.add_argument('--outdir',
                 default = os.curdir,
                 help = 'Directory to download files into (defaults to pwd)')
+    parser_sources.add_argument('--tree', action = 'store_true',
+                help = 'Download sources for every module checkout under'
+                       ' --path, fetching each file only once')
     parser_sources.set_defaults(command = sources)
 
     # srpm creates a source rpm from the module content
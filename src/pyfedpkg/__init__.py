@@ -24,10 +24,26 @@ import ConfigParser
 import stat
 import StringIO
 import tempfile
+import time
+import fcntl
+import threading
+import Queue
+import multiprocessing
+import ctypes
+import json
+import select
+import errno
+import collections
+import zlib
+import bz2
+import glob
 
 # Define some global variables, put them here to make it easy to change
 LOOKASIDE = 'http://cvs.fedoraproject.org/repo/pkgs'
 LOOKASIDEHASH = 'md5'
+# Other hashes to work out whenever a source file is read, so they are
+# already recorded when the lookaside moves to a new hash type
+LOOKASIDEEXTRAHASHES = []
 LOOKASIDE_CGI = 'https://cvs.fedoraproject.org/repo/pkgs/upload.cgi'
 GITBASEURL = 'ssh://%(user)s@pkgs.stg.fedoraproject.org/%(module)s'
 ANONGITURL = 'git://pkgs.stg.fedoraproject.org/%(module)s'
@@ -35,6 +51,65 @@ UPLOADEXTS = ['tar', 'gz', 'bz2', 'lzma', 'xz', 'Z', 'zip', 'tff', 'bin',
               'tbz', 'tbz2', 'tlz', 'txz', 'pdf', 'rpm', 'jar', 'war', 'db',
               'cpio', 'jisp', 'egg', 'gem']
 BRANCHFILTER = 'FC?-\d\d?|master'
+# How many bytes to read at a time when hashing files
+HASHBLOCKSIZE = 1024 * 1024
+# How many source files to download from the lookaside at the same time
+MAXDOWNLOADS = 4
+# How many files to upload to the lookaside at the same time
+MAXUPLOADS = 4
+# How many modules to clone at the same time
+MAXCLONES = 8
+# How many modules to look up the latest commit of at the same time
+MAXLSREMOTES = 16
+# Where fedpkg keeps things it can always recreate
+CACHEBASE = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                        os.path.expanduser('~/.cache')),
+                         'fedpkg')
+# Shared cache of lookaside files, so each file is only downloaded once
+CACHEDIR = os.path.join(CACHEBASE, 'lookaside')
+# Record of files already hashed, so unchanged files are not hashed again
+VERIFYINDEX = os.path.join(CACHEBASE, 'verified')
+CACHEMAXSIZE = 10 * 1024 * 1024 * 1024 # 10 GiB
+# rpm's numbers for the hash types it can use for file digests
+RPMDIGESTALGOS = {1: 'md5', 2: 'sha1', 8: 'sha256', 9: 'sha384',
+                  10: 'sha512'}
+# Latest commits we looked up recently, and for how many seconds to trust
+# them.  Kept short since a push makes them stale.
+HEADSCACHE = os.path.join(CACHEBASE, 'heads')
+HEADSMAXAGE = 30
+# Results of linting each rpm, so unchanged rpms aren't linted again
+LINTCACHE = os.path.join(CACHEBASE, 'rpmlint')
+# Whether local builds use ccache unless told otherwise
+CCACHE = False
+# Compiler caches for local builds, one per module and branch
+CCACHEDIR = os.path.join(CACHEBASE, 'ccache')
+# Most each of those caches may hold, in ccache -M terms
+CCACHEMAXSIZE = '5G'
+# Where the distributions put the ccache compiler wrappers
+CCACHEWRAPPERS = ['/usr/lib64/ccache', '/usr/lib/ccache']
+# Arches rpmbuild can build for on each local arch, for local --all-arches
+LOCALARCHES = {'x86_64': ['x86_64', 'i686'],
+               'i686': ['i686'],
+               'ppc64': ['ppc64', 'ppc'],
+               'ppc': ['ppc'],
+               's390x': ['s390x', 's390'],
+               's390': ['s390']}
+# How many lines of build output to keep in memory for error reports
+TAILLINES = 50
+# Most mock builds to run at the same time, each needs its own chroot
+MOCKMAXJOBS = 4
+# Memory to keep free for each mock build that is running
+MOCKMEMORY = 2 * 1024 * 1024 * 1024 # 2 GiB
+# Where mock keeps its configs
+MOCKCONFIGDIR = '/etc/mock'
+# Name of the record of which rpmbuild stages are done, in .git
+STAGESFILE = 'fedpkg-stages'
+# The rpmbuild stages we can short-circuit to, in order
+BUILDSTAGES = ['prep', 'build', 'install']
+# Name of the spec parse cache kept in each module's .git directory
+SPECCACHE = 'fedpkg-spec'
+# How many spec parses to remember per module
+SPECCACHEENTRIES = 8
 
 # Define our own error class
 class FedpkgError(Exception):
@@ -54,31 +129,237 @@ log = logging.getLogger("fedpkg")
 log.addHandler(h)
 
 # Define some helper functions, they start with _
-def _hash_file(file, hashtype):
-    """Return the hash of a file given a hash type"""
+def _fadvise_sequential(fd):
+    """Tell the kernel we are about to read a file from start to end.
 
+    This is only a hint to read ahead more, so any problem is ignored.
+
+    """
+
+    POSIX_FADV_SEQUENTIAL = 2
     try:
-        sum = hashlib.new(hashtype)
-    except ValueError:
-        raise FedpkgError('Invalid hash type: %s' % hashtype)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        else:
+            ctypes.CDLL(None).posix_fadvise64(fd, ctypes.c_longlong(0),
+                                              ctypes.c_longlong(0),
+                                              POSIX_FADV_SEQUENTIAL)
+    except (OSError, AttributeError):
+        pass
+
+def _hash_file_digests(file, hashtypes):
+    """Return a dict of hash type to hash of a file for several hash types
+
+    The file is only read once no matter how many hash types are asked for.
+
+    """
+
+    sums = {}
+    for hashtype in hashtypes:
+        try:
+            sums[hashtype] = hashlib.new(hashtype)
+        except ValueError:
+            raise FedpkgError('Invalid hash type: %s' % hashtype)
 
     input = open(file, 'rb')
+    _fadvise_sequential(input.fileno())
     # Loop through the file reading chunks at a time as to not
     # put the entire file in memory.  That would suck for DVDs
     while True:
-        chunk = input.read(8192) # magic number!  Taking suggestions
+        chunk = input.read(HASHBLOCKSIZE)
         if not chunk:
             break # we're done with the file
-        sum.update(chunk)
+        for sum in sums.values():
+            sum.update(chunk)
     input.close()
-    return sum.hexdigest()
+    digests = {}
+    for hashtype, sum in sums.items():
+        digests[hashtype] = sum.hexdigest()
+    return digests
+
+def _hash_file(file, hashtype):
+    """Return the hash of a file given a hash type"""
+
+    return _hash_file_digests(file, [hashtype])[hashtype]
+
+def _cpu_count():
+    """Return the number of cpus we can use, at least 1"""
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _run_parallel(function, items, workers=None):
+    """Call function once for each item using a pool of threads.
+
+    workers is the most calls to make at the same time, defaults to the
+    number of cpus
+
+    Returns a list of (result, error) tuples in the same order as items.
+    error is None if the call worked, or the exception it raised.
+
+    """
+
+    if workers is None:
+        workers = _cpu_count()
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for i in range(len(items)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (function(items[i]), None)
+            except Exception, e:
+                results[i] = (None, e)
+
+    threads = []
+    for n in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        # Don't hold up the exit if somebody hits ^C
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # A plain join() can't be interrupted
+        while thread.isAlive():
+            thread.join(0.5)
+    return results
+
+def _tee_command(command, logfile=None, shell=False, env=None, prefix='',
+                 echo=True, tailsize=TAILLINES, timeout=None):
+    """Run a command and pass its output on as it arrives.
+
+    command is what to hand Popen, with shell saying how to run it and env
+    being the environment for it
+
+    logfile is an optional file to write each line to with a timestamp
+
+    Lines are logged with prefix in front of them, standard output at info
+    and standard error at error level, unless echo is False in which case
+    they are only logged at debug level.
+
+    Only the last tailsize lines are kept in memory, however much output
+    there is.
+
+    timeout is the most seconds to let the command run for, after which it
+    is killed and we raise.
+
+    Returns the returncode, a list of the kept lines and the cpu seconds
+    the command used.
+
+    """
+
+    try:
+        proc = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, shell=shell)
+    except OSError, e:
+        raise FedpkgError(e)
+    output = None
+    if logfile:
+        output = open(logfile, 'w')
+    tail = collections.deque(maxlen=tailsize)
+    streams = {proc.stdout.fileno(): (log.info, ''),
+               proc.stderr.fileno(): (log.error, '')}
+
+    def emit(fd, line):
+        if output:
+            output.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                       line))
+        tail.append(line)
+        if echo:
+            streams[fd][0]('%s%s' % (prefix, line))
+        else:
+            log.debug('%s%s' % (prefix, line))
+
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+    try:
+        while streams:
+            wait = None
+            if deadline:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    proc.kill()
+                    _wait_command(proc)
+                    if not isinstance(command, basestring):
+                        command = subprocess.list2cmdline(command)
+                    raise FedpkgError('%s%s timed out after %s seconds' %
+                                      (prefix, command, timeout))
+            try:
+                ready = select.select(streams.keys(), [], [], wait)[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 65536)
+                (logger, partial) = streams[fd]
+                if not data:
+                    # End of output, flush what is left without a newline
+                    if partial:
+                        emit(fd, partial)
+                    del streams[fd]
+                    continue
+                lines = (partial + data).split('\n')
+                streams[fd] = (logger, lines.pop())
+                for line in lines:
+                    emit(fd, line)
+        _wait_command(proc)
+    finally:
+        if output:
+            output.close()
+    return (proc.returncode, list(tail), proc.cputime)
+
+def _wait_command(proc, block=True):
+    """Wait for a Popen object, keeping what cpu its process used
 
-def _run_command(cmd, shell=False, env=None):
+    The usage of just this process is taken with wait4, so commands run at
+    the same time don't count against each other.  The cpu seconds end up
+    in proc.cputime, which is None if something else reaped it first.
+
+    Returns the returncode, or None if block is False and it still runs.
+
+    """
+
+    if proc.returncode is not None:
+        return proc.returncode
+    flags = 0
+    if not block:
+        flags = os.WNOHANG
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(proc.pid, flags)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            proc.cputime = None
+            return proc.wait()
+    if not pid:
+        return None
+    proc.cputime = usage.ru_utime + usage.ru_stime
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode
+
+def _run_command(cmd, shell=False, env=None, timeout=None):
     """Run the given command.
 
     Will determine if caller is on a real tty and if so stream to the tty
 
-    Or else will run and log output.
+    Or else will log the output line by line as it comes.
 
     cmd is a list of the command and arguments
 
@@ -86,6 +367,8 @@ def _run_command(cmd, shell=False, env=None):
 
     env is a dict of environment variables to use (if any)
 
+    timeout is the most seconds to let the command run for (if any)
+
     Raises on error, or returns nothing.
 
     """
@@ -101,66 +384,508 @@ def _run_command(cmd, shell=False, env=None):
     command = cmd
     if shell:
         command = ' '.join(cmd)
+    started = time.time()
     # Check to see if we're on a real tty, if so, stream it baby!
     if sys.stdout.isatty():
         log.debug('Running %s directly on the tty' %
                   subprocess.list2cmdline(cmd))
         try:
-            subprocess.check_call(command, env=environ, stdout=sys.stdout,
-                                  stderr=sys.stderr, shell=shell)
-        except subprocess.CalledProcessError, e:
+            proc = subprocess.Popen(command, env=environ, stdout=sys.stdout,
+                                    stderr=sys.stderr, shell=shell)
+            if timeout:
+                while _wait_command(proc, block=False) is None:
+                    if time.time() - started > timeout:
+                        proc.kill()
+                        _wait_command(proc)
+                        raise FedpkgError('%s timed out after %s seconds' %
+                                          (subprocess.list2cmdline(cmd),
+                                           timeout))
+                    time.sleep(0.1)
+            else:
+                _wait_command(proc)
+        except OSError, e:
             raise FedpkgError(e)
         except KeyboardInterrupt:
             raise FedpkgError()
+        returncode = proc.returncode
+        cpu = proc.cputime
+        report = log.debug
+        error = ''
     else:
-        # Ok, we're not on a live tty, so pipe and log.
+        # Ok, we're not on a live tty, so pipe and log as we go.
         log.debug('Running %s and logging output' %
                   subprocess.list2cmdline(cmd))
-        try:
-            proc = subprocess.Popen(command, env=environ,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, shell=shell)
-            output, error = proc.communicate()
-        except OSError, e:
-            raise FedpkgError(e)
-        log.info(output)
-        if error:
-            log.error(error)
-        if proc.returncode:
-            raise FedpkgError('Command %s returned code %s with error: %s' %
-                              (subprocess.list2cmdline(cmd),
-                               proc.returncode,
-                               error))
+        (returncode, tail, cpu) = _tee_command(command, shell=shell,
+                                               env=environ, timeout=timeout)
+        # Without a tty the log is the record of what happened, so say
+        # what it cost there
+        report = log.info
+        error = '\n'.join(tail)
+    took = '%.1fs wall clock' % (time.time() - started)
+    if cpu is not None:
+        took += ', %.1fs cpu' % cpu
+    report('%s took %s' % (subprocess.list2cmdline(cmd), took))
+    if returncode:
+        raise FedpkgError('Command %s returned code %s with error: %s' %
+                          (subprocess.list2cmdline(cmd), returncode, error))
     return
 
-def _verify_file(file, hash, hashtype):
+class _Download(object):
+    """Keep track of a single transfer run by _download_files
+
+    The data is hashed as it arrives and written to a .part file next to the
+    real one, so nothing has to be read back to check it.  If the transfer
+    is interrupted the .part file is kept, and the next attempt hashes what
+    is already there and asks the server for the rest with a range request.
+    The checksum is part of the .part file name so a partial download is
+    never resumed against different content.
+
+    """
+
+    def __init__(self, url, outfile, csum, hashtype):
+        self.url = url
+        self.outfile = outfile
+        self.csum = csum
+        self.hashtype = hashtype
+        dirname, basename = os.path.split(outfile)
+        self.partfile = os.path.join(dirname, '.%s.%s.part' % (basename, csum))
+        self.output = None
+        self.sum = None
+        # Bytes we already had when this attempt started
+        self.offset = 0
+        self.total = 0
+        self.done = 0
+        self.tries = 0
+        try:
+            hashlib.new(hashtype)
+        except ValueError:
+            raise FedpkgError('Invalid hash type: %s' % hashtype)
+
+    def open(self):
+        """Open the .part file, picking up any earlier partial download.
+
+        Returns the number of bytes already downloaded.
+
+        """
+
+        self.tries += 1
+        self.sum = hashlib.new(self.hashtype)
+        self.offset = 0
+        self.total = 0
+        self.done = 0
+        if not os.path.exists(self.partfile):
+            self.output = open(self.partfile, 'wb')
+            return 0
+        # Rebuild the digest from what is already on disk
+        self.output = open(self.partfile, 'r+b')
+        while True:
+            chunk = self.output.read(1024 * 1024)
+            if not chunk:
+                break
+            self.sum.update(chunk)
+            self.offset += len(chunk)
+        self.output.seek(0, 2)
+        return self.offset
+
+    def complete(self):
+        """Return True if what we have so far matches the checksum"""
+
+        return self.sum.hexdigest() == self.csum
+
+    def write(self, data):
+        """Write function for pycurl, hashes the data on the way to disk"""
+
+        self.output.write(data)
+        self.sum.update(data)
+
+    def progress(self, dltotal, dlnow, ultotal, ulnow):
+        """Progress function for pycurl, remembers where we are"""
+
+        self.total = dltotal
+        self.done = dlnow
+
+    def finish(self, mtime=-1):
+        """Move the download into place if it verifies.
+
+        mtime is the remote timestamp to set on the file, if known
+
+        Returns None on success or the reason it failed.
+
+        """
+
+        self.output.close()
+        if not self.complete():
+            os.remove(self.partfile)
+            return 'failed checksum'
+        # Keep the remote timestamp like curl -R does
+        if mtime > 0:
+            os.utime(self.partfile, (mtime, mtime))
+        os.rename(self.partfile, self.outfile)
+        return None
+
+    def abort(self):
+        """Stop this attempt, keeping what we have for next time"""
+
+        self.output.close()
+        if not os.path.getsize(self.partfile):
+            os.remove(self.partfile)
+
+    def discard(self):
+        """Throw away the partial download so the next attempt starts over"""
+
+        if os.path.exists(self.partfile):
+            os.remove(self.partfile)
+
+def _download_files(downloads, callback=None, maxconns=MAXDOWNLOADS,
+                    maxtries=3):
+    """Download several files at once, verifying them as they arrive.
+
+    downloads is a list of (url, outfile, checksum, hashtype) tuples
+
+    callback is an optional progress callback.  It is called with the bytes
+    downloaded so far, the total bytes, the bytes since the last call, the
+    seconds since the last call and the total seconds elapsed, the same as
+    the koji upload callback
+
+    maxconns is the most transfers to run at the same time
+
+    maxtries is how many times to try a transfer that keeps getting cut off
+    part way through.  Each try resumes where the last one stopped.
+
+    A file only shows up at outfile once it has fully downloaded and matched
+    its checksum.  Interrupted downloads are left in .part files and resumed
+    by the next call.
+
+    Returns a list of (outfile, error) tuples for the files that failed.
+
+    """
+
+    # libcurl error codes we handle specially
+    E_HTTP_RETURNED_ERROR = 22
+    E_RANGE_ERROR = 33
+    pending = [_Download(url, outfile, csum, hashtype) for
+               (url, outfile, csum, hashtype) in downloads]
+    transfers = pending[:]
+    failed = []
+    active = {}
+    # Set up one curl handle per connection, they get reused for each file
+    multi = pycurl.CurlMulti()
+    handles = []
+    for i in range(min(maxconns, len(pending))):
+        curl = pycurl.Curl()
+        # These options came from Makefile.common
+        curl.setopt(pycurl.HTTPHEADER, ['Pragma:'])
+        curl.setopt(pycurl.FAILONERROR, 1)
+        curl.setopt(pycurl.OPT_FILETIME, 1)
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.MAXREDIRS, 5)
+        curl.setopt(pycurl.CONNECTTIMEOUT, 30)
+        curl.setopt(pycurl.NOPROGRESS, 0)
+        handles.append(curl)
+    free = handles[:]
+    start = last = time.time()
+    lastdone = 0
+    while pending or active:
+        # Hand out any free handles to the files still waiting
+        while pending and free:
+            download = pending.pop(0)
+            try:
+                offset = download.open()
+                # We may have everything already and just not renamed it
+                if offset and download.complete():
+                    error = download.finish()
+                    if error:
+                        failed.append((download.outfile, error))
+                    continue
+            except (IOError, OSError), e:
+                failed.append((download.outfile, e))
+                continue
+            if offset:
+                log.info('Resuming %s from byte %s' %
+                         (os.path.basename(download.outfile), offset))
+            log.debug('Downloading %s' % download.url)
+            curl = free.pop()
+            curl.setopt(pycurl.URL, download.url)
+            curl.setopt(pycurl.RESUME_FROM_LARGE, offset)
+            curl.setopt(pycurl.WRITEFUNCTION, download.write)
+            curl.setopt(pycurl.PROGRESSFUNCTION, download.progress)
+            multi.add_handle(curl)
+            active[curl] = download
+        # Let curl do as much work as it can right now
+        while True:
+            ret, running = multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        # Deal with the transfers that finished
+        while True:
+            queued, ok, err = multi.info_read()
+            finished = [(curl, 0, None) for curl in ok]
+            finished.extend(err)
+            for curl, errno, error in finished:
+                multi.remove_handle(curl)
+                free.append(curl)
+                download = active.pop(curl)
+                if not error:
+                    error = download.finish(curl.getinfo(pycurl.INFO_FILETIME))
+                    if not error:
+                        continue
+                    if download.offset and download.tries < maxtries:
+                        # What we resumed from was bad, try again from scratch
+                        log.debug('Resumed %s failed checksum, retrying' %
+                                  download.url)
+                        pending.append(download)
+                    else:
+                        failed.append((download.outfile, error))
+                    continue
+                download.abort()
+                retry = False
+                if errno == E_RANGE_ERROR or \
+                   (errno == E_HTTP_RETURNED_ERROR and download.offset and
+                    curl.getinfo(pycurl.HTTP_CODE) == 416):
+                    # The server won't resume this one, start it over
+                    log.debug('Could not resume %s: %s' % (download.url,
+                                                          error))
+                    download.discard()
+                    retry = True
+                elif download.done:
+                    # We were getting somewhere, so pick up where we stopped
+                    retry = True
+                if retry and download.tries < maxtries:
+                    log.debug('Retrying %s: %s' % (download.url, error))
+                    pending.append(download)
+                else:
+                    failed.append((download.outfile, error))
+            if not queued:
+                break
+        # Report the combined progress of everything we have started
+        now = time.time()
+        if callback and (now - last >= 0.5 or not (pending or active)):
+            done = sum([t.offset + t.done for t in transfers])
+            total = sum([t.offset + t.total for t in transfers])
+            if total:
+                callback(done, total, max(done - lastdone, 0), now - last,
+                         now - start)
+                lastdone = done
+                last = now
+        if active:
+            multi.select(1.0)
+    for curl in handles:
+        curl.close()
+    multi.close()
+    return failed
+
+def _link_file(src, dst):
+    """Put the content of src at dst as cheaply as we can.
+
+    Tries a hard link first, then a reflink, and falls back to a real copy.
+    dst is replaced atomically if it already exists.
+
+    """
+
+    # ioctl to share the data blocks of two files on btrfs and friends
+    FICLONE = 0x40049409
+    dirname, basename = os.path.split(dst)
+    (fd, tmpfile) = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    os.close(fd)
+    try:
+        try:
+            os.remove(tmpfile)
+            os.link(src, tmpfile)
+        except OSError:
+            # Probably a different filesystem, so do it the long way
+            input = open(src, 'rb')
+            output = open(tmpfile, 'wb')
+            try:
+                try:
+                    fcntl.ioctl(output.fileno(), FICLONE, input.fileno())
+                except IOError:
+                    shutil.copyfileobj(input, output, 1024 * 1024)
+            finally:
+                input.close()
+                output.close()
+            shutil.copystat(src, tmpfile)
+        os.rename(tmpfile, dst)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+def _verify_file(file, hash, hashtype, index=None, extrahashes=[]):
     """Given a file, a hash of that file, and a hashtype, verify.
 
+    index is an optional VerifyIndex.  If the file has not changed since it
+    was last hashed the recorded hash is used instead of reading the file.
+
+    extrahashes is a list of other hash types to work out and record in the
+    index if the file has to be read anyway
+
     Returns True if the file verifies, False otherwise
 
     """
 
     # get the hash
-    sum = _hash_file(file, hashtype)
+    sum = None
+    if index:
+        sum = index.lookup(file, hashtype)
+    if not sum:
+        hashtypes = [hashtype]
+        if index:
+            hashtypes.extend([h for h in extrahashes if h != hashtype])
+        digests = _hash_file_digests(file, hashtypes)
+        sum = digests[hashtype]
+        if index:
+            for name, digest in digests.items():
+                index.record(file, name, digest)
     # now do the comparison
     if sum == hash:
         return True
     return False
 
-def _get_build_arches_from_srpm(srpm, arches):
-    """Given the path to an srpm, determine the possible build arches
+def _fetch_sources(entries, lookaside=LOOKASIDE, hashtype=LOOKASIDEHASH,
+                   cache=None, index=None, extrahashes=[], paranoid=False,
+                   callback=None, maxconns=MAXDOWNLOADS):
+    """Make sure every listed source file is present and valid.
 
-    Use supplied arches as a filter, only return compatible arches
+    entries is a list of (module, file, checksum, outfile) tuples
+
+    lookaside is the base url to download from
+
+    cache is an optional SourceCache to take files from and add them to
+
+    index is an optional VerifyIndex to skip hashing unchanged files, and
+    paranoid makes it forget what it knows about these files first
+
+    callback is an optional progress callback, see _download_files
+
+    Each checksum is only fetched once, however many entries list it.  The
+    other entries get linked to the first good copy, so the same tarball in
+    several checkouts is downloaded and stored once.
+
+    Returns a tuple of the bytes downloaded, the bytes that were already
+    present or reused, and a list of (outfile, error) tuples for the files
+    that are still missing or could not be checked.
 
     """
 
-    archlist = arches
-    hdr = koji.get_rpm_header(srpm)
-    if hdr[rpm.RPMTAG_SOURCEPACKAGE] != 1:
-        raise FedpkgError('%s is not a source package.' % srpm)
-    buildarchs = hdr[rpm.RPMTAG_BUILDARCHS]
-    exclusivearch = hdr[rpm.RPMTAG_EXCLUSIVEARCH]
-    excludearch = hdr[rpm.RPMTAG_EXCLUDEARCH]
+    downloaded = 0
+    reused = 0
+    failed = []
+    # Where to find a verified copy of each checksum
+    good = {}
+    # The entries for each checksum, in the order we first saw them
+    wanted = {}
+    order = []
+    # Outfiles that are taken care of
+    done = set()
+    # Whether the cache grew, and so might need pruning
+    stored = False
+
+    if paranoid and index:
+        for (module, file, csum, outfile) in entries:
+            index.forget(outfile)
+
+    # See what we already have, hashing in parallel if we have to
+    def verify(entry):
+        (module, file, csum, outfile) = entry
+        return os.path.exists(outfile) and _verify_file(outfile, csum,
+                                                        hashtype, index,
+                                                        extrahashes)
+    results = _run_parallel(verify, entries)
+    for entry, (valid, error) in zip(entries, results):
+        (module, file, csum, outfile) = entry
+        if error:
+            failed.append((outfile, 'could not verify: %s' % error))
+            done.add(outfile)
+            continue
+        if csum not in wanted:
+            wanted[csum] = []
+            order.append(csum)
+        wanted[csum].append(entry)
+        if valid:
+            good.setdefault(csum, outfile)
+            done.add(outfile)
+            reused += os.path.getsize(outfile)
+
+    # Next best is a copy some other checkout put in the cache
+    def from_cache(csum):
+        (module, file, csum, outfile) = wanted[csum][0]
+        if not cache.get(hashtype, csum, outfile):
+            return False
+        if _verify_file(outfile, csum, hashtype, index, extrahashes):
+            log.info('Using cached %s' % file)
+            return True
+        log.warn('Cached copy of %s is corrupt, removing it' % file)
+        cache.remove(hashtype, csum)
+        return False
+    missing = [csum for csum in order if csum not in good]
+    if cache:
+        results = _run_parallel(from_cache, missing)
+    else:
+        results = [(False, None)] * len(missing)
+    downloads = []
+    for csum, (cached, error) in zip(missing, results):
+        (module, file, csum, outfile) = wanted[csum][0]
+        if cached:
+            good[csum] = outfile
+            done.add(outfile)
+            reused += os.path.getsize(outfile)
+            continue
+        url = '%s/%s/%s/%s/%s' % (lookaside, module, file, csum, file)
+        log.info('Downloading %s' % file)
+        downloads.append((url, outfile, csum, hashtype))
+
+    # Files are checked as they download, so anything that comes back
+    # without an error is already in place and verified.
+    errors = {}
+    if downloads:
+        errors = dict(_download_files(downloads, callback=callback,
+                                      maxconns=maxconns))
+    for url, outfile, csum, hashtype in downloads:
+        if outfile in errors:
+            failed.append((outfile, errors[outfile]))
+            done.add(outfile)
+            continue
+        downloaded += os.path.getsize(outfile)
+        if index:
+            index.record(outfile, hashtype, csum)
+        if cache and cache.add(hashtype, csum, outfile):
+            stored = True
+        good[csum] = outfile
+        done.add(outfile)
+
+    # Hand out the good copies to everybody else that wants them
+    for csum in order:
+        for (module, file, csum, outfile) in wanted[csum]:
+            if outfile in done:
+                continue
+            done.add(outfile)
+            if csum not in good:
+                failed.append((outfile, 'could not get %s' % file))
+                continue
+            try:
+                _link_file(good[csum], outfile)
+            except (IOError, OSError), e:
+                failed.append((outfile, e))
+                continue
+            if index:
+                index.record(outfile, hashtype, csum)
+            reused += os.path.getsize(outfile)
+
+    if index:
+        index.write()
+    if stored:
+        cache.prune()
+    return (downloaded, reused, failed)
+
+def _filter_build_arches(arches, buildarchs, exclusivearch, excludearch):
+    """Return the arches out of arches a package can be built for
+
+    buildarchs, exclusivearch and excludearch are the lists from the
+    package's BuildArch, ExclusiveArch and ExcludeArch tags.
+
+    """
+
+    archlist = list(arches)
     # Reduce by buildarchs
     if buildarchs:
         archlist = [a for a in archlist if a in buildarchs]
@@ -174,44 +899,99 @@ def _get_build_arches_from_srpm(srpm, arches):
     if 'noarch' not in excludearch and ('noarch' in buildarchs or \
                                         'noarch' in exclusivearch):
         archlist.append('noarch')
+    return archlist
+
+def _get_build_arches_from_srpm(srpm, arches):
+    """Given the path to an srpm, determine the possible build arches
+
+    Use supplied arches as a filter, only return compatible arches
+
+    """
+
+    hdr = koji.get_rpm_header(srpm)
+    if hdr[rpm.RPMTAG_SOURCEPACKAGE] != 1:
+        raise FedpkgError('%s is not a source package.' % srpm)
+    archlist = _filter_build_arches(arches, hdr[rpm.RPMTAG_BUILDARCHS] or [],
+                                    hdr[rpm.RPMTAG_EXCLUSIVEARCH] or [],
+                                    hdr[rpm.RPMTAG_EXCLUDEARCH] or [])
     # See if we have anything compatible.  Should we raise here?
     if not archlist:
         raise FedpkgError('No compatible build arches found in %s' % srpm)
     return archlist
 
-def _srpmdetails(srpm):
-    """Return a tuple of package name, package files, and upload files."""
+def _branch_mockconfig(branch, arch):
+    """Return the mock config for building branch on arch, or None"""
+
+    if branch.startswith('F-'):
+        return 'fedora-%s-%s' % (branch.split('-')[1], arch)
+    elif branch.startswith('EL-'):
+        return 'epel-%s-%s' % (branch.split('-')[1], arch)
+    elif branch in ('devel', 'master'):
+        return 'fedora-devel-%s' % arch
+    # Not all branches have a config
+    return None
+
+def _free_memory():
+    """Return how many bytes of memory are free for new work, or None"""
 
-    # get the name
-    cmd = ['rpm', '-qp', '--qf', '%{NAME}', srpm]
-            # Run the command
-    log.debug('Running: %s' % subprocess.list2cmdline(cmd))
     try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output, error = proc.communicate()
-    except OSError, e:
-        raise FedpkgError(e)
-    name = output
-    if error:
-        log.error(error)
-        raise FedpkgError('Error querying srpm')
+        meminfo = open('/proc/meminfo', 'r')
+    except IOError:
+        return None
+    values = {}
+    for line in meminfo.readlines():
+        try:
+            (name, value) = line.split(':', 1)
+            values[name] = int(value.split()[0]) * 1024
+        except (ValueError, IndexError):
+            continue
+    meminfo.close()
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+    # Older kernels don't work it out for us
+    try:
+        return values['MemFree'] + values['Buffers'] + values['Cached']
+    except KeyError:
+        return None
+
+def _read_srpm(srpm):
+    """Read the header of an srpm in process.
+
+    Returns the header and the open srpm, positioned at the start of its
+    payload.
 
-    # now get the files and upload files
+    """
+
+    ts = rpm.TransactionSet()
+    # We only want to look at it, not to check who signed it
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+    fd = os.open(srpm, os.O_RDONLY)
+    try:
+        hdr = ts.hdrFromFdno(fd)
+    except rpm.error, e:
+        os.close(fd)
+        raise FedpkgError('Error querying srpm: %s' % e)
+    if hdr[rpm.RPMTAG_SOURCEPACKAGE] != 1:
+        os.close(fd)
+        raise FedpkgError('%s is not a source package.' % srpm)
+    return (hdr, os.fdopen(fd, 'rb'))
+
+def _srpmdetails(hdr):
+    """Return a tuple of package name, package files, and upload files.
+
+    Also returns the file digests as a dict of file name to digest, and the
+    hash type of those digests.
+
+    """
+
+    name = hdr[rpm.RPMTAG_NAME]
+    # Source packages don't have directories, the base names are enough
+    contents = hdr[rpm.RPMTAG_BASENAMES] or []
+    sums = hdr[getattr(rpm, 'RPMTAG_FILEDIGESTS', rpm.RPMTAG_FILEMD5S)] or []
+    algo = getattr(rpm, 'RPMTAG_FILEDIGESTALGO', None)
+    hashtype = RPMDIGESTALGOS.get(algo and hdr[algo] or 1, 'md5')
     files = []
     uploadfiles = []
-    cmd = ['rpm', '-qpl', srpm]
-    log.debug('Running: %s' % subprocess.list2cmdline(cmd))
-    try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output, error = proc.communicate()
-    except OSError, e:
-        raise FedpkgError(e)
-    if error:
-        log.error(error)
-        raise FedpkgError('Error querying srpm')
-    contents = output.split()
     # Cycle through the stuff and sort correctly by its extension
     for file in contents:
         if file.rsplit('.')[-1] in UPLOADEXTS:
@@ -219,7 +999,173 @@ def _srpmdetails(srpm):
         else:
             files.append(file)
 
-    return((name, files, uploadfiles))
+    return((name, files, uploadfiles, dict(zip(contents, sums)), hashtype))
+
+class _Stream(object):
+    """Read exact amounts from an iterator of chunks of data"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = ''
+        # How much of the buffer has been read already.  Moving this along
+        # instead of cutting up the buffer keeps the small reads of cpio
+        # headers and names from copying what is left of a big chunk.
+        self.offset = 0
+
+    def read(self, size):
+        """Return size bytes, or less if the data runs out"""
+
+        end = self.offset + size
+        if end <= len(self.buffer):
+            data = self.buffer[self.offset:end]
+            self.offset = end
+            return data
+        pieces = [self.buffer[self.offset:]]
+        have = len(pieces[0])
+        while have < size:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            pieces.append(chunk)
+            have += len(chunk)
+        self.buffer = ''.join(pieces)
+        self.offset = min(size, len(self.buffer))
+        return self.buffer[:self.offset]
+
+def _command_chunks(cmd, input):
+    """Run cmd with input as its stdin and yield its output in chunks"""
+
+    try:
+        proc = subprocess.Popen(cmd, stdin=input, stdout=subprocess.PIPE)
+    except OSError, e:
+        raise FedpkgError('Could not run %s: %s' % (cmd[0], e))
+    while True:
+        chunk = proc.stdout.read(HASHBLOCKSIZE)
+        if not chunk:
+            break
+        yield chunk
+    if proc.wait():
+        raise FedpkgError('Could not decompress the srpm payload')
+
+def _payload_chunks(input, compressor):
+    """Decompress an rpm payload from input as it is read, in chunks
+
+    Compressors we don't know are left to rpm2cpio, which wants the whole
+    package rather than just the payload.
+
+    """
+
+    if compressor in ('xz', 'lzma'):
+        # Nothing in the standard library for these
+        for chunk in _command_chunks(['xz', '--decompress', '--stdout'],
+                                     input):
+            yield chunk
+        return
+    if compressor == 'bzip2':
+        decompressor = bz2.BZ2Decompressor()
+    elif compressor in ('gzip', None):
+        # The gzip header is taken care of by zlib
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        log.debug('Using rpm2cpio for %s compression' % compressor)
+        input.seek(0)
+        for chunk in _command_chunks(['rpm2cpio'], input):
+            yield chunk
+        return
+    while True:
+        chunk = input.read(HASHBLOCKSIZE)
+        if not chunk:
+            break
+        try:
+            yield decompressor.decompress(chunk)
+        except (IOError, EOFError, zlib.error), e:
+            raise FedpkgError('Could not decompress the srpm payload: %s' % e)
+
+def _extract_srpm(hdr, input, wanted, path):
+    """Write out the files in wanted from the payload of an srpm
+
+    hdr and input are from _read_srpm.  The cpio payload is read as a
+    stream, so only the files being written are ever held on disk and
+    nothing is held in memory.
+
+    Returns the list of files written.
+
+    """
+
+    compressor = hdr[rpm.RPMTAG_PAYLOADCOMPRESSOR] or None
+    stream = _Stream(_payload_chunks(input, compressor))
+    written = []
+
+    def skip(size):
+        # Padded to a multiple of four
+        if size % 4:
+            stream.read(4 - size % 4)
+
+    while True:
+        header = stream.read(110)
+        if len(header) < 110 or header[:6] not in ('070701', '070702'):
+            raise FedpkgError('The srpm payload is not a cpio archive')
+        fields = [int(header[6 + 8 * i:14 + 8 * i], 16) for i in range(13)]
+        (mode, filesize, namesize) = (fields[1], fields[6], fields[11])
+        name = stream.read(namesize)[:-1]
+        skip(110 + namesize)
+        if name == 'TRAILER!!!':
+            break
+        if name.startswith('./'):
+            name = name[2:]
+        if name not in wanted or '/' in name:
+            # Read past it
+            left = filesize
+            while left > 0:
+                chunk = stream.read(min(left, HASHBLOCKSIZE))
+                if not chunk:
+                    raise FedpkgError('The srpm payload is truncated')
+                left -= len(chunk)
+        else:
+            (fd, tmpfile) = tempfile.mkstemp(dir=path, prefix='.%s.' % name)
+            output = os.fdopen(fd, 'wb')
+            try:
+                left = filesize
+                while left > 0:
+                    chunk = stream.read(min(left, HASHBLOCKSIZE))
+                    if not chunk:
+                        raise FedpkgError('The srpm payload is truncated')
+                    output.write(chunk)
+                    left -= len(chunk)
+                output.close()
+                os.chmod(tmpfile, mode & 0777)
+                os.rename(tmpfile, os.path.join(path, name))
+            except:
+                output.close()
+                os.remove(tmpfile)
+                raise
+            written.append(name)
+        skip(filesize)
+    input.close()
+    return written
+
+def _find_checkouts(path):
+    """Return a list of (module, path) for each module checkout under path
+
+    A checkout is any directory with a sources file and a spec file, which
+    covers both normal clones and the per branch directories made by
+    clone_with_dirs.
+
+    """
+
+    checkouts = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        # Don't wander into git metadata or bare repos
+        dirnames[:] = sorted([d for d in dirnames if not d.endswith('.git')])
+        if 'sources' not in filenames:
+            continue
+        specs = sorted([f for f in filenames if f.endswith('.spec')])
+        if specs:
+            checkouts.append((specs[0].split('.spec')[0], dirpath))
+            # Anything below a checkout is build output, not more checkouts
+            dirnames[:] = []
+    return checkouts
 
 def clean(dry=False, useignore=True):
     """Clean a module checkout of untracked files.
@@ -249,8 +1195,32 @@ def clean(dry=False, useignore=True):
     log.info(output)
     if error:
         log.error(error)
+    if not dry and not proc.returncode:
+        _forget_stages()
     return proc.returncode
 
+def _forget_stages():
+    """Drop the record of build stages done in this checkout
+
+    The stages recorded are only good while the trees they left behind
+    are still there, which a clean takes away.
+
+    """
+
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--git-dir'],
+                                stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        output, error = proc.communicate()
+    except OSError, e:
+        raise FedpkgError(e)
+    if proc.returncode:
+        return
+    stagesfile = os.path.join(output.strip(), STAGESFILE)
+    if os.path.exists(stagesfile):
+        log.debug('Removing %s' % stagesfile)
+        os.unlink(stagesfile)
+
 def switch_branch(branch=None, list=None):
     """Work with different branches.
 
@@ -273,7 +1243,8 @@ def switch_branch(branch=None, list=None):
             sys.exit(1)
     return
 
-def clone(module, user, path=os.getcwd(), branch=None, bare_dir=None):
+def clone(module, user, path=os.getcwd(), branch=None, bare_dir=None,
+          reference=None, quiet=False):
     """Clone a repo, optionally check out a specific branch.
 
     module is the name of the module to clone
@@ -285,6 +1256,11 @@ def clone(module, user, path=os.getcwd(), branch=None, bare_dir=None):
     bare_dir is the name of a directory to make a bare clone too if this is a
     bare clone. None otherwise.
 
+    reference is a local repo to borrow objects from instead of fetching
+    them, through git alternates.  None otherwise.
+
+    quiet keeps git from showing its progress
+
     Logs the output and returns nothing.
 
     """
@@ -293,35 +1269,82 @@ def clone(module, user, path=os.getcwd(), branch=None, bare_dir=None):
     giturl = GITBASEURL % {'user': user, 'module': module}
     # Create the command
     cmd = ['git', 'clone']
+    if quiet:
+        cmd.append('--quiet')
+    if reference:
+        cmd.extend(['--reference', reference])
     # do the clone
     if branch and bare_dir:
         log.debug('Cloning %s bare with branch %s' % (giturl, branch))
         cmd.extend(['--branch', branch, '--bare', giturl, bare_dir])
     elif branch:
         log.debug('Cloning %s with branch %s' % (giturl, branch))
-        cmd.extend(['--branch', branch, giturl])
+        cmd.extend(['--branch', branch, giturl, os.path.join(path, module)])
     elif bare_dir:
         log.debug('Cloning %s bare' % giturl)
         cmd.extend(['--bare', giturl, bare_dir])
     else:
         log.debug('Cloning %s' % giturl)
-        cmd.extend([giturl])
+        cmd.extend([giturl, os.path.join(path, module)])
     _run_command(cmd)
     return
 
-def clone_with_dirs(module, user, path=os.getcwd()):
+def clone_modules(modules, user, path=os.getcwd(), branch=None,
+                  reference=None, dirs=False, workers=MAXCLONES):
+    """Clone several modules at the same time.
+
+    modules is the list of module names to clone, into path
+
+    branch, reference and dirs (for clone_with_dirs) are used for every
+    module, see clone and clone_with_dirs
+
+    workers is the most clones to run at the same time
+
+    A failed clone doesn't stop the others, and the ones that worked are
+    kept.  Returns a list of (module, error) tuples for the modules that
+    could not be cloned, which is empty if all went well.
+
+    """
+
+    def clone_one(module):
+        log.info('Cloning %s' % module)
+        if dirs:
+            clone_with_dirs(module, user, path, reference=reference,
+                            quiet=True)
+        else:
+            clone(module, user, path, branch, reference=reference,
+                  quiet=True)
+
+    failed = []
+    for (module, (result, error)) in zip(modules,
+                                         _run_parallel(clone_one, modules,
+                                                       workers)):
+        if error:
+            if not isinstance(error, FedpkgError):
+                raise error
+            log.debug('Could not clone %s: %s' % (module, error))
+            failed.append((module, error))
+    return failed
+
+def clone_with_dirs(module, user, path=os.getcwd(), reference=None,
+                    quiet=False):
     """Clone a repo old style with subdirs for each branch.
 
     module is the name of the module to clone
 
-    gitargs is an option list of arguments to git clone
+    reference and quiet are passed on to clone for the bare clone
+
+    The branch directories are made at the same time, and borrow their
+    objects from one bare clone in .fedpkg.git through git alternates, so
+    the history is only stored once.  That bare clone has to be kept for as
+    long as the branch directories are.
 
     """
 
     # Get the full path of, and git object for, our directory of branches
     top_path = os.path.join(path, module)
     top_git = git.Git(top_path)
-    repo_path = os.path.join(top_path, 'fedpkg.git')
+    repo_path = os.path.join(top_path, '.fedpkg.git')
 
     # Create our new top directory
     try:
@@ -331,7 +1354,8 @@ def clone_with_dirs(module, user, path=os.getcwd()):
                 (module, e))
 
     # Create a bare clone first. This gives us a good list of branches
-    clone(module, user, top_path, bare_dir=repo_path)
+    clone(module, user, top_path, bare_dir=repo_path, reference=reference,
+          quiet=quiet)
     # Get the full path to, and a git object for, our new bare repo
     repo_git = git.Git(repo_path)
 
@@ -339,44 +1363,131 @@ def clone_with_dirs(module, user, path=os.getcwd()):
     branches = [x for x in repo_git.branch().split() if x != "*" and
             re.match(BRANCHFILTER, x)]
 
-    for branch in branches:
-        try:
-            # Make a local clone for our branch
-            top_git.clone("--branch", branch, repo_path, branch)
+    def clone_branch(branch):
+        # Make a local clone for our branch that shares the objects
+        top_git.clone("--shared", "--branch", branch, repo_path, branch)
 
-            # Set the origin correctly
-            branch_path = os.path.join(top_path, branch)
-            branch_git = git.Git(branch_path)
-            branch_git.config("--replace-all", "remote.origin.url",
-                    GITBASEURL % {'user': user, 'module': module})
-        except (git.GitCommandError, OSError), e:
-            raise FedpkgError('Could not locally clone %s from %s: %s' %
-                    (branch, repo_path, e))
+        # Set the origin correctly
+        branch_path = os.path.join(top_path, branch)
+        branch_git = git.Git(branch_path)
+        branch_git.config("--replace-all", "remote.origin.url",
+                GITBASEURL % {'user': user, 'module': module})
 
-    # We don't need this now. Ignore errors since keeping it does no harm
-    shutil.rmtree(repo_path, ignore_errors=True)
+    errors = []
+    for (branch, (result, error)) in zip(branches,
+                                         _run_parallel(clone_branch,
+                                                       branches)):
+        if error:
+            if not isinstance(error, (git.GitCommandError, OSError)):
+                raise error
+            errors.append('%s: %s' % (branch, error))
+    if errors:
+        raise FedpkgError('Could not locally clone from %s:\n%s' %
+                (repo_path, '\n'.join(errors)))
 
     # consistent with clone method since the commands should return 0 when
     # successful.
     return 0
 
+def _read_heads(maxage):
+    """Return the recently looked up commits as a dict of module to hash"""
+
+    heads = {}
+    try:
+        cache = open(HEADSCACHE, 'r')
+    except IOError:
+        return heads
+    now = time.time()
+    for line in cache.readlines():
+        try:
+            (module, when, hash) = line.split()
+            if now - float(when) <= maxage:
+                heads[module] = (float(when), hash)
+        except ValueError:
+            continue
+    cache.close()
+    return heads
+
+def _write_heads(heads):
+    """Write out the dict of module to (time, hash) of looked up commits
+
+    Errors are logged and otherwise ignored, this is just a shortcut.
+
+    """
+
+    try:
+        dirname = os.path.dirname(HEADSCACHE)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        (fd, tmpfile) = tempfile.mkstemp(dir=dirname, prefix='.heads.')
+        cache = os.fdopen(fd, 'w')
+        for module, (when, hash) in sorted(heads.items()):
+            cache.write('%s %r %s\n' % (module, when, hash))
+        cache.close()
+        os.rename(tmpfile, HEADSCACHE)
+    except (IOError, OSError), e:
+        log.debug('Could not write %s: %s' % (HEADSCACHE, e))
+
+def get_latest_commits(modules, maxage=HEADSMAXAGE, workers=MAXLSREMOTES):
+    """Discover the latest commit hash of several modules at once
+
+    The git ls-remote calls run at the same time, up to workers of them.
+    Hashes looked up less than maxage seconds ago are reused, set it to 0
+    to always ask.
+
+    Returns a dict of module to hash for the modules that worked, and a
+    list of (module, error) tuples for the ones that didn't.
+
+    """
+
+    # Keep what others may still want when we write the cache out again
+    cached = _read_heads(max(maxage, HEADSMAXAGE))
+    heads = {}
+    wanted = []
+    for module in modules:
+        if module in cached and time.time() - cached[module][0] <= maxage:
+            log.debug('Using recently looked up head of %s' % module)
+            heads[module] = cached[module][1]
+        elif module not in wanted:
+            wanted.append(module)
+
+    def ls_remote(module):
+        # This is stupid that I have to use subprocess :/
+        url = ANONGITURL % {'module': module}
+        cmd = ['git', 'ls-remote', url, 'master']
+        try :
+            proc = subprocess.Popen(cmd, stderr=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            output, error = proc.communicate()
+        except OSError, e:
+            raise FedpkgError(e)
+        if error or proc.returncode or not output.split():
+            raise FedpkgError('Got an error finding head for %s: %s' %
+                              (module, error.strip() or 'no master branch'))
+        # Return the hash sum
+        return output.split()[0]
+
+    failed = []
+    now = time.time()
+    for (module, (hash, error)) in zip(wanted,
+                                       _run_parallel(ls_remote, wanted,
+                                                     workers)):
+        if error:
+            failed.append((module, error))
+        else:
+            heads[module] = hash
+            cached[module] = (now, hash)
+    if wanted and len(failed) < len(wanted):
+        _write_heads(cached)
+    return (heads, failed)
+
 def get_latest_commit(module):
     """Discover the latest commit has for a given module and return it"""
 
-    # This is stupid that I have to use subprocess :/
-    url = ANONGITURL % {'module': module}
-    cmd = ['git', 'ls-remote', url, 'master']
-    try :
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        output, error = proc.communicate()
-    except OSError, e:
-        raise FedpkgError(e)
-    if error:
-        raise FedpkgError('Got an error finding head for %s: %s' %
-                          (module, error))
-    # Return the hash sum
-    return output.split()[0]
+    (heads, failed) = get_latest_commits([module], maxage=0)
+    if failed:
+        raise failed[0][1]
+    return heads[module]
 
 def import_srpm(srpm, path=os.getcwd()):
     """Import the contents of an srpm into a repo.
@@ -401,59 +1512,50 @@ def import_srpm(srpm, path=os.getcwd()):
     repo = git.Repo(path)
     if repo.is_dirty():
         raise FedpkgError('There are uncommitted changes in your repo')
+    oldpath = os.getcwd()
     # Get the details of the srpm
-    name, files, uploadfiles = _srpmdetails(srpm)
+    (hdr, input) = _read_srpm(srpm)
+    try:
+        name, files, uploadfiles, sums, hashtype = _srpmdetails(hdr)
 
-    # Need a way to make sure the srpm name matches the repo some how.
+        # Need a way to make sure the srpm name matches the repo some how.
 
-    # Get a list of files we're currently tracking
-    ourfiles = repo.git.ls_files().split()
-    # Trim out sources and .gitignore
-    try:
-        ourfiles.remove('.gitignore')
-        ourfiles.remove('sources')
-    except ValueError:
-        pass
-    try:
-        ourfiles.remove('sources')
-    except ValueError:
-        pass
+        # Get a set of files we're currently tracking, without our stock
+        # files
+        ourfiles = set(repo.git.ls_files().split())
+        ourfiles.difference_update(['.gitignore', 'sources'])
 
-    # Things work better if we're in our module directory
-    oldpath = os.getcwd()
-    os.chdir(path)
+        # Things work better if we're in our module directory
+        os.chdir(path)
 
-    # Look through our files and if it isn't in the new files, remove it.
-    for file in ourfiles:
-        if file not in files:
+        # Look through our files and if it isn't in the new files, remove it.
+        for file in sorted(ourfiles.difference(files)):
             log.info("Removing no longer used file: %s" % file)
             rv = repo.index.remove([file])
             os.remove(file)
 
-    # Extract new files
-    cmd = ['rpm2cpio', srpm]
-    # We have to force cpio to copy out (u) because git messes with
-    # timestamps
-    cmd2 = ['cpio', '-iud', '--quiet']
-
-    rpmcall = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    cpiocall = subprocess.Popen(cmd2, stdin=rpmcall.stdout)
-    output, err = cpiocall.communicate()
-    if output:
-        log.debug(output)
-    if err:
+        # Only write out the files that are new or different
+        wanted = set()
+        for file in files + uploadfiles:
+            if file in sums and os.path.exists(file) and \
+               _hash_file(file, hashtype) == sums[file]:
+                log.debug('%s is unchanged' % file)
+                continue
+            wanted.add(file)
+        written = _extract_srpm(hdr, input, wanted, os.getcwd())
+        log.debug('Extracted %s' % ', '.join(written))
+
+        # And finally add all the files we know about (and our stock files)
+        for file in ('.gitignore', 'sources'):
+            if not os.path.exists(file):
+                # Create the file
+                open(file, 'w').close()
+            files.append(file)
+        rv = repo.index.add(files)
+    finally:
+        # Return to the caller and let them take it from there.
+        input.close()
         os.chdir(oldpath)
-        raise FedpkgError("Got an error from rpm2cpio: %s" % err)
-
-    # And finally add all the files we know about (and our stock files)
-    for file in ('.gitignore', 'sources'):
-        if not os.path.exists(file):
-            # Create the file
-            open(file, 'w').close()
-        files.append(file)
-    rv = repo.index.add(files)
-    # Return to the caller and let them take it from there.
-    os.chdir(oldpath)
     return(uploadfiles)
 
 def new(path=os.getcwd()):
@@ -471,96 +1573,869 @@ def new(path=os.getcwd()):
     return repo.git.diff('-M', tag)
 
 
-class Lookaside(object):
-    """ Object for interacting with the lookaside cache. """
+def prefetch_sources(path=os.getcwd(), callback=None,
+                     maxconns=MAXDOWNLOADS, lookaside=LOOKASIDE):
+    """Download the sources for every module checkout under path.
+
+    path is the top of the tree to scan
+
+    lookaside is the base url to download from
+
+    callback is an optional progress callback, see _download_files
+
+    maxconns is the most downloads to run at the same time
+
+    The sources files of all the checkouts are read, and every file they
+    list is fetched once even if several modules or branches want it.  The
+    shared source cache and verify index are used like sources() does.
+
+    Returns a tuple of the number of checkouts found, the bytes downloaded,
+    the bytes that were already present or reused, and a list of (outfile,
+    error) tuples for the files that could not be fetched.  A sources file
+    that can't be read or has a bad line shows up in that list too, and
+    the rest of the tree is still fetched.
+
+    """
+
+    entries = []
+    failed = []
+    checkouts = _find_checkouts(path)
+    for module, checkout in checkouts:
+        sourcesfile = os.path.join(checkout, 'sources')
+        try:
+            archives = open(sourcesfile, 'r').readlines()
+        except IOError, e:
+            failed.append((sourcesfile, 'could not read: %s' % e))
+            continue
+        for number, archive in enumerate(archives):
+            if not archive.strip():
+                continue
+            try:
+                csum, file = archive.split()
+            except ValueError:
+                failed.append((sourcesfile, 'bad line %s for %s: %r' %
+                               (number + 1, module, archive.strip())))
+                continue
+            entries.append((module, file, csum, os.path.join(checkout, file)))
+    log.info('Found %s files in %s checkouts' % (len(entries),
+                                                len(checkouts)))
+    (downloaded, reused, fetchfailed) = _fetch_sources(
+            entries, lookaside, cache=SourceCache(), index=VerifyIndex(),
+            extrahashes=LOOKASIDEEXTRAHASHES, callback=callback,
+            maxconns=maxconns)
+    return (len(checkouts), downloaded, reused, failed + fetchfailed)
+
+class Lookaside(object):
+    """ Object for interacting with the lookaside cache.
+
+    Curl handles are kept in a pool and run through one multi handle, so
+    every request made with the same object reuses the open connections
+    instead of doing a new TCP connection and TLS handshake.  Call close()
+    when done with it.
+
+    """
+
+    def __init__(self, url=LOOKASIDE_CGI):
+        self.lookaside_cgi = url
+        self.cert_file = os.path.expanduser('~/.fedora.cert')
+        self.ca_cert_file = os.path.expanduser('~/.fedora-server-ca.cert')
+        self.__multi = None
+        self.__free = []
+        self.__handles = []
+
+    def _setup_curl(self, curl):
+        """
+        Common curl setup options used for all requests to lookaside.
+        """
+
+        curl.setopt(pycurl.URL, self.lookaside_cgi)
+
+        # Set the users Fedora certificate:
+        if os.path.exists(self.cert_file):
+            curl.setopt(pycurl.SSLCERT, self.cert_file)
+
+        # Set the Fedora CA certificate:
+        if os.path.exists(self.ca_cert_file):
+            curl.setopt(pycurl.CAINFO, self.ca_cert_file)
+
+    def _create_curl(self):
+        """
+        Create a new curl handle for the pool.
+        """
+        curl = pycurl.Curl()
+
+        for cert in (self.cert_file, self.ca_cert_file):
+            if not os.path.exists(cert):
+                log.warn("Missing certificate: %s" % cert)
+        self._setup_curl(curl)
+        self.__handles.append(curl)
+
+        return curl
+
+    def _perform(self, requests, maxconns=MAXDOWNLOADS):
+        """
+        Run requests against the lookaside CGI over the pooled connections.
+
+        requests is a list of dicts of extra curl options, one per request
+
+        maxconns is the most requests to run at the same time
+
+        Returns a list with an entry for each request in the same order,
+        None if the request worked or the error message if it did not.
+        """
+
+        if not self.__multi:
+            self.__multi = pycurl.CurlMulti()
+        multi = self.__multi
+        results = [None] * len(requests)
+        pending = range(len(requests))
+        active = {}
+        while pending or active:
+            while pending and len(active) < maxconns:
+                i = pending.pop(0)
+                if self.__free:
+                    curl = self.__free.pop()
+                else:
+                    curl = self._create_curl()
+                for option, value in requests[i].items():
+                    curl.setopt(option, value)
+                multi.add_handle(curl)
+                active[curl] = i
+            while True:
+                ret, running = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, ok, err = multi.info_read()
+                finished = [(curl, None) for curl in ok]
+                finished.extend([(curl, msg) for (curl, errno, msg) in err])
+                for curl, error in finished:
+                    multi.remove_handle(curl)
+                    results[active.pop(curl)] = error
+                    # Reset drops our per request options but keeps the
+                    # connection open for the next request
+                    curl.reset()
+                    self._setup_curl(curl)
+                    self.__free.append(curl)
+                if not queued:
+                    break
+            if active:
+                multi.select(1.0)
+        return results
+
+    def close(self):
+        """
+        Close all the pooled connections.
+        """
+
+        for curl in self.__handles:
+            curl.close()
+        if self.__multi:
+            self.__multi.close()
+        self.__multi = None
+        self.__free = []
+        self.__handles = []
+
+    def files_exist(self, files):
+        """
+        Check which of a list of files exist in the lookaside cache.
+
+        files is a list of (pkg_name, filename, md5sum) tuples
+
+        Returns a list of True or False for each file, in the same order.
+
+        A FedpkgError will be thrown if any of the checks look bad or
+        something goes wrong. (i.e. the lookaside URL cannot be reached, or
+        the package named does not exist)
+        """
+
+        # String buffers, used to receive output from the curl requests:
+        buffers = []
+        requests = []
+        for pkg_name, filename, md5sum in files:
+            buf = StringIO.StringIO()
+            buffers.append(buf)
+            # Setup the POST data for lookaside CGI request. The use of
+            # 'filename' here appears to be what differentiates this
+            # request from an actual file upload.
+            post_data = [
+                    ('name', pkg_name),
+                    ('md5sum', md5sum),
+                    ('filename', filename)]
+            requests.append({pycurl.WRITEFUNCTION: buf.write,
+                             pycurl.HTTPPOST: post_data})
+
+        errors = self._perform(requests)
+
+        results = []
+        failed = []
+        for (pkg_name, filename, md5sum), buf, error in zip(files, buffers,
+                                                            errors):
+            output = buf.getvalue().strip()
+            # Lookaside CGI script returns these strings depending on
+            # whether or not the file exists:
+            if not error and output == "Available":
+                results.append(True)
+            elif not error and output == "Missing":
+                results.append(False)
+            else:
+                # Something unexpected happened, will trigger if the
+                # lookaside URL cannot be reached, the package named does not
+                # exist, and probably some other scenarios as well.
+                failed.append(filename)
+                results.append(None)
+        if failed:
+            raise FedpkgError("Error checking for %s at: %s" %
+                    (', '.join(failed), self.lookaside_cgi))
+        return results
+
+    def file_exists(self, pkg_name, filename, md5sum):
+        """
+        Return True if the given file exists in the lookaside cache, False
+        if not.
+
+        A FedpkgError will be thrown if the request looks bad or something
+        goes wrong. (i.e. the lookaside URL cannot be reached, or the package
+        named does not exist)
+        """
+
+        return self.files_exist([(pkg_name, filename, md5sum)])[0]
+
+    def upload_files(self, files, callback=None, maxconns=MAXUPLOADS):
+        """
+        Upload several files to the lookaside cache at the same time.
+
+        files is a list of (pkg_name, filepath, md5sum) tuples
+
+        callback is an optional koji style progress callback for all the
+        uploads combined, called with the bytes sent, the total bytes, the
+        bytes since the last call, the seconds since the last call and the
+        total seconds elapsed.
+
+        maxconns is the most uploads to run at the same time
+
+        Every file is tried, then a FedpkgError is raised listing the ones
+        that failed, if any.
+        """
+
+        sizes = [os.path.getsize(filepath) for (pkg_name, filepath, md5sum)
+                 in files]
+        sent = [0] * len(files)
+        total = sum(sizes)
+        start = time.time()
+        state = {'last': start, 'sent': 0}
+
+        def report():
+            now = time.time()
+            done = sum(sent)
+            if done == state['sent']:
+                return
+            if now - state['last'] >= 0.5 or done == total:
+                callback(done, total, done - state['sent'],
+                         now - state['last'], now - start)
+                state['last'] = now
+                state['sent'] = done
+
+        def progress_for(i):
+            def progress(dltotal, dlnow, ultotal, ulnow):
+                # The upload includes the form around the file, so scale
+                # it back to the size of the file itself
+                if ultotal:
+                    sent[i] = int(sizes[i] * ulnow / ultotal)
+                    report()
+            return progress
+
+        requests = []
+        for i in range(len(files)):
+            (pkg_name, filepath, md5sum) = files[i]
+            # Setup the POST data for lookaside CGI request. The use of
+            # 'file' here appears to trigger the actual upload:
+            post_data = [
+                    ('name', pkg_name),
+                    ('md5sum', md5sum),
+                    ('file', (pycurl.FORM_FILE, filepath))]
+
+            # Throw away the page we get back, like curl -o /dev/null
+            options = {pycurl.HTTPPOST: post_data,
+                       pycurl.FAILONERROR: 1,
+                       pycurl.WRITEFUNCTION: lambda data: None}
+            if callback:
+                options[pycurl.NOPROGRESS] = 0
+                options[pycurl.PROGRESSFUNCTION] = progress_for(i)
+            requests.append(options)
+
+        errors = self._perform(requests, maxconns=maxconns)
+        failed = ['%s: %s' % (filepath, error) for ((pkg_name, filepath,
+                  md5sum), error) in zip(files, errors) if error]
+        if failed:
+            raise FedpkgError('Could not upload to %s:\n%s' %
+                    (self.lookaside_cgi, '\n'.join(failed)))
+
+    def upload_file(self, pkg_name, filepath, md5sum, callback=None):
+        """
+        Upload a file to the lookaside cache.
+
+        callback is an optional progress callback, see upload_files
+        """
+
+        self.upload_files([(pkg_name, filepath, md5sum)], callback=callback)
+
+
+class SourceCache(object):
+    """ Content addressed cache of lookaside files shared by all modules.
+
+    Files are stored as path/<hashtype>/<checksum>/<filename> and handed out
+    as hard links where possible, so the same tarball in several checkouts
+    only takes up space once.  The modification time of the checksum
+    directory records when the entry was last used.
+
+    """
+
+    def __init__(self, path=CACHEDIR, maxsize=CACHEMAXSIZE):
+        self.path = path
+        self.maxsize = maxsize
+
+    def _entry(self, hashtype, csum):
+        """Return the directory for a given entry"""
+
+        return os.path.join(self.path, hashtype, csum)
+
+    def get(self, hashtype, csum, outfile):
+        """Put a cached copy of a file at outfile.
+
+        Returns True if the file was in the cache, False if not.
+
+        The caller should still verify the file, a hard linked copy could
+        have been changed in place by some other checkout.
+
+        """
+
+        entry = self._entry(hashtype, csum)
+        try:
+            files = [f for f in os.listdir(entry) if not f.startswith('.')]
+        except OSError:
+            return False
+        if not files:
+            return False
+        try:
+            _link_file(os.path.join(entry, files[0]), outfile)
+            # Mark the entry as recently used
+            os.utime(entry, None)
+        except (IOError, OSError), e:
+            log.debug('Could not use cached %s: %s' % (csum, e))
+            return False
+        return True
+
+    def add(self, hashtype, csum, filepath):
+        """Add a verified file to the cache.
+
+        Errors are logged and otherwise ignored, the cache is just a
+        shortcut.
+
+        Returns True if the file was new to the cache.
+
+        """
+
+        entry = self._entry(hashtype, csum)
+        dest = os.path.join(entry, os.path.basename(filepath))
+        if os.path.exists(dest):
+            return False
+        try:
+            if not os.path.isdir(entry):
+                os.makedirs(entry)
+            _link_file(filepath, dest)
+        except (IOError, OSError), e:
+            log.debug('Could not cache %s: %s' % (filepath, e))
+            return False
+        return True
+
+    def remove(self, hashtype, csum):
+        """Drop an entry from the cache"""
+
+        shutil.rmtree(self._entry(hashtype, csum), ignore_errors=True)
+
+    def entries(self):
+        """Return a list of what is in the cache.
+
+        Each item is a (lastused, size, hashtype, checksum, path) tuple,
+        least recently used first.
+
+        """
+
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for hashtype in os.listdir(self.path):
+            typedir = os.path.join(self.path, hashtype)
+            if not os.path.isdir(typedir):
+                continue
+            for csum in os.listdir(typedir):
+                entry = os.path.join(typedir, csum)
+                try:
+                    lastused = os.stat(entry).st_mtime
+                    for f in os.listdir(entry):
+                        if f.startswith('.'):
+                            continue
+                        path = os.path.join(entry, f)
+                        entries.append((lastused, os.stat(path).st_size,
+                                        hashtype, csum, path))
+                except OSError:
+                    # Somebody else is removing it right now
+                    continue
+        entries.sort()
+        return entries
+
+    def size(self):
+        """Return the total size of the cache in bytes"""
+
+        return sum([entry[1] for entry in self.entries()])
+
+    def prune(self, maxsize=None):
+        """Remove the least recently used files until the cache fits.
+
+        maxsize defaults to the size the cache was created with
+
+        Returns a tuple of the number of files removed and the bytes freed.
+
+        """
+
+        if maxsize is None:
+            maxsize = self.maxsize
+        entries = self.entries()
+        total = sum([entry[1] for entry in entries])
+        removed = 0
+        freed = 0
+        while entries and total > maxsize:
+            (lastused, size, hashtype, csum, path) = entries.pop(0)
+            log.debug('Pruning %s from the cache' % path)
+            self.remove(hashtype, csum)
+            total -= size
+            freed += size
+            removed += 1
+        return (removed, freed)
+
+
+class VerifyIndex(object):
+    """ Remember the hashes of files we have already read.
+
+    Entries are keyed by the full path and hash type and hold the size,
+    modification time and inode the file had when it was hashed.  As long
+    as none of those change the file is assumed to still have that hash.
+
+    """
+
+    def __init__(self, path=VERIFYINDEX):
+        self.path = path
+        self.modified = False
+        self.__entries = None
+        self.__lock = threading.Lock()
+
+    def _load(self):
+        """Read the index file the first time it is needed"""
+
+        # We get used from several threads at once
+        self.__lock.acquire()
+        try:
+            if self.__entries is None:
+                self._read()
+        finally:
+            self.__lock.release()
+
+    def _read(self):
+        """Read the index file"""
+
+        self.__entries = {}
+        try:
+            index = open(self.path, 'r')
+        except IOError:
+            return
+        for line in index.readlines():
+            try:
+                (hashtype, size, mtime, inode, sum,
+                 file) = line.rstrip('\n').split(' ', 5)
+                self.__entries[(file, hashtype)] = (int(size), float(mtime),
+                                                    int(inode), sum)
+            except ValueError:
+                # Not worth failing over, it will get rewritten
+                continue
+        index.close()
+
+    def _stat(self, file):
+        """Return the key and the stat data we care about for a file"""
+
+        info = os.stat(file)
+        return (os.path.abspath(file),
+                (info.st_size, info.st_mtime, info.st_ino))
+
+    def lookup(self, file, hashtype):
+        """Return the recorded hash of a file, or None if it has changed"""
+
+        self._load()
+        try:
+            (path, info) = self._stat(file)
+        except OSError:
+            return None
+        entry = self.__entries.get((path, hashtype))
+        if entry and entry[:3] == info:
+            log.debug('Using recorded %s of %s' % (hashtype, file))
+            return entry[3]
+        return None
+
+    def record(self, file, hashtype, sum):
+        """Remember the hash of a file as it is right now"""
+
+        self._load()
+        (path, info) = self._stat(file)
+        self.__entries[(path, hashtype)] = info + (sum,)
+        self.modified = True
+
+    def forget(self, file):
+        """Drop everything we know about a file"""
+
+        self._load()
+        path = os.path.abspath(file)
+        for key in self.__entries.keys():
+            if key[0] == path:
+                del self.__entries[key]
+                self.modified = True
+
+    def write(self):
+        """Write the index out if anything changed.
+
+        Entries for files that no longer exist are dropped.  Errors are
+        logged and otherwise ignored, the index is just a shortcut.
+
+        """
+
+        if not self.modified:
+            return
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            (fd, tmpfile) = tempfile.mkstemp(dir=dirname, prefix='.verified.')
+            index = os.fdopen(fd, 'w')
+            for (file, hashtype), (size, mtime, inode, sum) in \
+                self.__entries.items():
+                if os.path.exists(file):
+                    index.write('%s %s %r %s %s %s\n' % (hashtype, size, mtime,
+                                                         inode, sum, file))
+            index.close()
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError), e:
+            log.debug('Could not write %s: %s' % (self.path, e))
+            return
+        self.modified = False
 
-    def __init__(self, url=LOOKASIDE_CGI):
-        self.lookaside_cgi = url
-        self.cert_file = os.path.expanduser('~/.fedora.cert')
-        self.ca_cert_file = os.path.expanduser('~/.fedora-server-ca.cert')
+class SpecCache(object):
+    """ Remember what parsing a spec file gave us.
 
-    def _create_curl(self):
-        """
-        Common curl setup options used for all requests to lookaside.
-        """
-        curl = pycurl.Curl()
+    Entries are keyed by a hash of everything that goes into the parse: the
+    spec file contents, the branch, the macros we define and every macro
+    file on rpm's macro path.  Files the spec pulls in with %include are not part
+    of the key.
 
-        curl.setopt(pycurl.URL, self.lookaside_cgi)
+    The cache is a small JSON file, usually in the module's .git directory.
+    Only the last SPECCACHEENTRIES parses are kept.
 
-        # Set the users Fedora certificate:
-        if os.path.exists(self.cert_file):
-            curl.setopt(pycurl.SSLCERT, self.cert_file)
-        else:
-            log.warn("Missing certificate: %s" % self.cert_file)
+    """
 
-        # Set the Fedora CA certificate:
-        if os.path.exists(self.ca_cert_file):
-            curl.setopt(pycurl.CAINFO, self.ca_cert_file)
-        else:
-            log.warn("Missing certificate: %s" % self.ca_cert_file)
+    # rpm's own macro path, for when rpm won't tell us what it is
+    macropath = ('/usr/lib/rpm/macros:/usr/lib/rpm/macros.d/macros.*:'
+                 '/usr/lib/rpm/%{_target}/macros:/etc/rpm/macros.*:'
+                 '/etc/rpm/macros:/etc/rpm/%{_target}/macros:~/.rpmmacros')
 
-        return curl
+    def __init__(self, path):
+        self.path = path
 
-    def file_exists(self, pkg_name, filename, md5sum):
-        """
-        Return True if the given file exists in the lookaside cache, False
-        if not.
+    def key(self, specfile, branch, macros):
+        """Work out the cache key for a parse of specfile"""
+
+        sum = hashlib.sha1()
+        sum.update(open(specfile, 'rb').read())
+        sum.update('\0%s\0' % branch)
+        for name, value in macros:
+            sum.update('%s %s\0' % (name, value))
+        sum.update(getattr(rpm, '__version__', ''))
+        # Any of the macro files rpm reads can change the outcome too
+        for macrofile in self._macrofiles():
+            try:
+                sum.update('%s\0' % macrofile)
+                sum.update(open(macrofile, 'rb').read())
+            except IOError:
+                pass
+        return sum.hexdigest()
+
+    def _macrofiles(self):
+        """Return the macro files rpm reads, in order"""
+
+        macropath = rpm.expandMacro('%{?_macrofiles}') or \
+                    rpm.expandMacro(self.macropath)
+        files = []
+        for pattern in macropath.split(':'):
+            pattern = os.path.expanduser(pattern.strip())
+            if pattern:
+                files.extend(sorted(glob.glob(pattern)))
+        return files
+
+    def _read(self):
+        """Return the cache contents, a dict of key: (time, info)"""
+
+        try:
+            cache = open(self.path, 'r')
+        except IOError:
+            return {}
+        try:
+            try:
+                entries = json.load(cache)
+            except ValueError:
+                # Not worth failing over, it will get rewritten
+                return {}
+        finally:
+            cache.close()
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def lookup(self, key):
+        """Return the parse results stored under key, or None"""
+
+        entry = self._read().get(key)
+        if not entry:
+            return None
+        info = entry[1]
+        # JSON gave us unicode strings and turned our tuples into lists
+        for name in ('name', 'version', 'release'):
+            info[name] = str(info[name])
+        info['sources'] = [(str(source), num, flags) for (source, num, flags)
+                           in info['sources']]
+        log.debug('Using cached spec parse from %s' % self.path)
+        return info
+
+    def record(self, key, info):
+        """Store the parse results under key.
+
+        Errors are logged and otherwise ignored, the cache is just a
+        shortcut.
 
-        A FedpkgError will be thrown if the request looks bad or something
-        goes wrong. (i.e. the lookaside URL cannot be reached, or the package
-        named does not exist)
         """
 
-        # String buffer, used to receive output from the curl request:
-        buf = StringIO.StringIO()
+        entries = self._read()
+        entries[key] = (time.time(), info)
+        if len(entries) > SPECCACHEENTRIES:
+            # Drop the oldest
+            keep = sorted(entries.items(), key=lambda item: item[1][0])
+            entries = dict(keep[-SPECCACHEENTRIES:])
+        try:
+            (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                             prefix='.%s.' %
+                                             os.path.basename(self.path))
+            cache = os.fdopen(fd, 'w')
+            json.dump(entries, cache)
+            cache.close()
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError), e:
+            log.debug('Could not write %s: %s' % (self.path, e))
 
-        # Setup the POST data for lookaside CGI request. The use of
-        # 'filename' here appears to be what differentiates this
-        # request from an actual file upload.
-        post_data = [
-                ('name', pkg_name),
-                ('md5sum', md5sum),
-                ('filename', filename)]
 
-        curl = self._create_curl()
-        curl.setopt(pycurl.WRITEFUNCTION, buf.write)
-        curl.setopt(pycurl.HTTPPOST, post_data)
+class SpecFile(object):
+    """ A spec file, read once and indexed.
 
-        curl.perform()
-        curl.close()
-        output = buf.getvalue().strip()
+    The sections, the Source and Patch tags and the patches that get
+    applied are all found in one pass over the file, expanding macros the
+    way rpm would as far as we can: %define, %global, Name, Version and
+    Release are tracked, anything else is left to rpm.  Conditionals are
+    not evaluated, so everything in an %if counts.
 
-        # Lookaside CGI script returns these strings depending on whether
-        # or not the file exists:
-        if output == "Available":
-            return True
-        if output == "Missing":
-            return False
+    macros is an optional dict of macros to start with, such as dist.
+
+    """
+
+    # What starts a new section
+    sectionnames = ('package', 'description', 'prep', 'build', 'install',
+                    'check', 'clean', 'files', 'changelog', 'pre', 'post',
+                    'preun', 'postun', 'pretrans', 'posttrans', 'triggerin',
+                    'triggerun', 'triggerpostun', 'verifyscript')
+    tagre = re.compile(r'^(name|version|release|source|patch)(\d*)\s*:\s*'
+                       r'(.*?)\s*$', re.IGNORECASE)
+    definere = re.compile(r'^%(?:define|global)\s+(\w+)(?:\([^)]*\))?\s+'
+                          r'(.*?)\s*$')
+    macrore = re.compile(r'%%|%\{([?!]*)(\w+)(?::([^{}]*))?\}|%(\w+)')
+    patchre = re.compile(r'^%patch(\d*)\b(.*)$')
+    patchrefre = re.compile(r'%\{?PATCH(\d+)\b')
+    # %patch options that take the next word as their value
+    patchargopts = ('-p', '-F', '-b', '-z', '-d', '-o')
+
+    def __init__(self, path, macros={}):
+        self.path = path
+        self.lines = open(path, 'r').readlines()
+        self.macros = dict(macros)
+        # Section name to a list of (first, last + 1) line numbers, the
+        # first line being the section header.  Sections like %files can
+        # show up several times.
+        self.sections = {}
+        # Source and patch numbers to expanded file names
+        self.sources = {}
+        self.patches = {}
+        # Numbers of the patches that get applied, and whether all of them
+        # do through %autosetup or similar
+        self.applied = set()
+        self.applyall = False
+        self._index()
+
+    def expand(self, text):
+        """Expand the macros in text"""
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%%'
+            (flags, name, alt, bare) = match.groups()
+            name = name or bare
+            if '?' in flags:
+                # %{?name} and %{!?name}, with an optional value
+                defined = name in self.macros or \
+                          rpm.expandMacro('%%{?%s:1}' % name) == '1'
+                if ('!' in flags) == defined:
+                    return ''
+                if alt is not None:
+                    return alt
+                if '!' in flags:
+                    return ''
+            if name in self.macros:
+                return self.macros[name]
+            return rpm.expandMacro('%%{%s}' % name)
+
+        for i in range(10):
+            expanded = self.macrore.sub(replace, text)
+            if expanded == text:
+                break
+            text = expanded
+        return text.replace('%%', '%')
+
+    def _index(self):
+        """Go through the file once, filling in everything we know"""
+
+        current = 'preamble'
+        start = 0
+        for i in range(len(self.lines)):
+            line = self.lines[i]
+            if line.startswith('%'):
+                word = line[1:].split(None, 1)
+                if word and word[0] in self.sectionnames:
+                    self.sections.setdefault(current, []).append((start, i))
+                    (current, start) = (word[0], i)
+                    continue
+            if current == 'changelog':
+                continue
+            match = self.definere.match(line)
+            if match:
+                self.macros[match.group(1)] = self.expand(match.group(2))
+                continue
+            if current in ('preamble', 'package'):
+                match = self.tagre.match(line)
+                if not match:
+                    continue
+                (tag, number, value) = match.groups()
+                tag = tag.lower()
+                value = self.expand(value)
+                if tag == 'source':
+                    self.sources[int(number or 0)] = value
+                elif tag == 'patch':
+                    self.patches[int(number or 0)] = value
+                elif current == 'preamble':
+                    # Sub packages have their own, they don't count
+                    self.macros[tag] = value
+                continue
+            match = self.patchre.match(line)
+            if match:
+                self.applied.update(self._patch_numbers(match.group(1),
+                                                        match.group(2)))
+            elif line.startswith('%autosetup') or \
+                 line.startswith('%autopatch') or '%{patches}' in line:
+                self.applyall = True
+            for number in self.patchrefre.findall(line):
+                self.applied.add(int(number))
+        self.sections.setdefault(current, []).append((start, len(self.lines)))
+
+    def _patch_numbers(self, number, args):
+        """Return the numbers of the patches one %patch line applies
+
+        number is the one in %patchN, args the rest of the line.  Patches
+        are named by that number, by any -P N options and by the numbers
+        given as plain arguments, as in %patch 3 -p1.  A %patch naming
+        none of them applies patch 0.
 
-        # Something unexpected happened, will trigger if the lookaside URL
-        # cannot be reached, the package named does not exist, and probably
-        # some other scenarios as well.
-        raise FedpkgError("Error checking for %s at: %s" %
-                (filename, self.lookaside_cgi))
+        """
 
-    def upload_file(self, pkg_name, filepath, md5sum):
-        """ Upload a file to the lookaside cache. """
+        numbers = []
+        if number:
+            numbers.append(int(number))
+        words = self.expand(args).split()
+        i = 0
+        while i < len(words):
+            word = words[i]
+            if word == '-P' and i + 1 < len(words):
+                i += 1
+                if words[i].isdigit():
+                    numbers.append(int(words[i]))
+            elif word.startswith('-P') and word[2:].isdigit():
+                numbers.append(int(word[2:]))
+            elif word in self.patchargopts:
+                # Skip the value, it is not a patch number
+                i += 1
+            elif word.isdigit():
+                numbers.append(int(word))
+            i += 1
+        if not numbers:
+            numbers.append(0)
+        return numbers
+
+    def text(self, name):
+        """Return the text of a section, with its header line"""
+
+        return ''.join([''.join(self.lines[first:last]) for (first, last) in
+                        self.sections.get(name, [])])
+
+    def section(self, name):
+        """Return the lines of a section, without its header line"""
+
+        lines = []
+        for (first, last) in self.sections.get(name, []):
+            if name == 'preamble':
+                lines.extend(self.lines[first:last])
+            else:
+                lines.extend(self.lines[first + 1:last])
+        return lines
 
-        # Setup the POST data for lookaside CGI request. The use of
-        # 'file' here appears to trigger the actual upload:
-        post_data = [
-                ('name', pkg_name),
-                ('md5sum', md5sum),
-                ('file', (pycurl.FORM_FILE, filepath))]
+    def buildsubdir(self):
+        """Return the directory %prep unpacks the sources into
 
-        curl = self._create_curl()
-        curl.setopt(pycurl.HTTPPOST, post_data)
+        That is the one %setup or %autosetup is given with -n, or
+        NAME-VERSION.  Returns None when %prep uses neither.
 
-        # TODO: disabled until safe way to test is known. Watchout for the
-        # file parameter:
-        curl.perform()
-        curl.close()
+        """
 
+        for line in self.section('prep'):
+            words = line.split()
+            if not words or words[0] not in ('%setup', '%autosetup'):
+                continue
+            directory = '%{name}-%{version}'
+            for i in range(1, len(words)):
+                if words[i] == '-n' and i + 1 < len(words):
+                    directory = words[i + 1]
+                elif words[i].startswith('-n') and len(words[i]) > 2:
+                    directory = words[i][2:]
+            return self.expand(directory)
+        return None
+
+    def applied_patches(self):
+        """Return the file names of the patches that get applied"""
+
+        if self.applyall:
+            return [os.path.basename(patch) for patch in
+                    self.patches.values()]
+        return [os.path.basename(self.patches[number]) for number in
+                self.applied if number in self.patches]
 
 class GitIgnore(object):
     """ Smaller wrapper for managing a .gitignore file and it's entries. """
@@ -619,24 +2494,224 @@ class PackageModule:
         branch = open(os.path.join(self.path, 'branch'), 'r').read().strip()
         return branch
 
+    def _findspec(self):
+        """Find the specfile within a package module"""
+
+        # Get a list of files in the path we're looking at
+        files = os.listdir(self.path)
+        # Search the files for the first one that ends with ".spec"
+        for f in files:
+            if f.endswith('.spec'):
+                return f
+        raise FedpkgError('No spec file found.')
+
     def _getlocalarch(self):
         """Get the local arch as defined by rpm"""
-        
-        return subprocess.Popen(['rpm --eval %{_arch}'], shell=True,
-                        stdout=subprocess.PIPE).communicate()[0].strip('\n')
+
+        return rpm.expandMacro('%{_arch}')
+
+    def _parse_spec(self):
+        """Parse the spec file in process with our macros defined.
+
+        Returns a dict with the name, version and release of the main
+        package, the buildarchs, exclusivearch and excludearch lists, and
+        the sources list of (filename, number, flags) tuples.
+
+        """
+
+        for name, value in self.rpmmacros:
+            rpm.addMacro(name, value)
+        try:
+            try:
+                spec = rpm.spec(os.path.join(self.path, self.spec))
+            except ValueError, e:
+                raise FedpkgError('Could not parse %s: %s' %
+                                  (self.spec, str(e).strip()))
+        finally:
+            # Leave the global macro context the way we found it
+            for name, value in self.rpmmacros:
+                rpm.delMacro(name)
+        # When there are sub packages the first one is the main package
+        hdr = spec.packages[0].header
+        srchdr = getattr(spec, 'sourceHeader', None) or hdr
+        info = {'name': hdr[rpm.RPMTAG_NAME],
+                'version': hdr[rpm.RPMTAG_VERSION],
+                'release': hdr[rpm.RPMTAG_RELEASE],
+                'sources': list(spec.sources)}
+        for key, tag in (('buildarchs', rpm.RPMTAG_BUILDARCHS),
+                         ('exclusivearch', rpm.RPMTAG_EXCLUSIVEARCH),
+                         ('excludearch', rpm.RPMTAG_EXCLUDEARCH)):
+            info[key] = list(srchdr[tag] or [])
+        return info
+
+    def _getspecinfo(self):
+        """Get the spec parse results, from the spec cache if we can"""
+
+        gitdir = os.path.join(self.path, '.git')
+        if not os.path.isdir(gitdir):
+            return self._parse_spec()
+        speccache = SpecCache(os.path.join(gitdir, SPECCACHE))
+        key = speccache.key(os.path.join(self.path, self.spec), self.branch,
+                            self.rpmmacros)
+        info = speccache.lookup(key)
+        if info is None:
+            info = self._parse_spec()
+            speccache.record(key, info)
+        return info
+
+    def _getmockconfig(self):
+        """Get the mock config for our branch on the local arch"""
+
+        return _branch_mockconfig(self.branch, self.localarch)
+
+    def _getrpmmacros(self):
+        """Get the macros we build with as a list of (name, value) tuples
+
+        These are used in process when parsing the spec and passed to the
+        rpm commands as rpmdefines.
+
+        """
+
+        return [('_sourcedir', self.path),
+                ('_specdir', self.path),
+                ('_builddir', self.path),
+                ('_srcrpmdir', self.path),
+                ('_rpmdir', self.path),
+                ('dist', self.dist),
+                (self.distvar, self.distval),
+                (self.distvar, '1')]
+
+    def _getrpmdefines(self):
+        """Get the rpm command line options that define our macros"""
+
+        return ["--define '%s %s'" % macro for macro in self.rpmmacros]
+
+    def _getrepo(self):
+        """Get the git repo object for the module"""
+
+        try:
+            return git.Repo(self.path)
+        except git.errors.InvalidGitRepositoryError:
+            raise FedpkgError('%s is not a valid repo' % self.path)
+
+    # Attributes that cost something to compute, mapped to the method that
+    # computes them.  They are filled in on first use and then kept, so
+    # commands only pay for what they actually look at.
+    _lazy = {'spec': _findspec,
+             'module': lambda self: self.spec.split('.spec')[0],
+             'specfile': lambda self: SpecFile(os.path.join(self.path,
+                                                            self.spec),
+                                               dict(self.rpmmacros)),
+             'localarch': _getlocalarch,
+             'mockconfig': _getmockconfig,
+             'rpmmacros': _getrpmmacros,
+             'rpmdefines': _getrpmdefines,
+             'specinfo': _getspecinfo,
+             'ver': lambda self: self.specinfo['version'],
+             'rel': lambda self: self.specinfo['release'],
+             'repo': _getrepo}
+
+    def __getattr__(self, name):
+        # Only called when name isn't set on the instance yet
+        if name not in self._lazy:
+            raise AttributeError(name)
+        value = self._lazy[name](self)
+        setattr(self, name, value)
+        return value
+
+    def _ccache_start(self):
+        """Get a compiler cache ready for a local build, if we use one
+
+        Each module and branch gets its own ccache directory, limited to
+        CCACHEMAXSIZE, with its statistics cleared so the hit rate can be
+        reported afterwards.
+
+        Returns a dict of environment variables and a list of rpm defines
+        to build with, both empty when ccache isn't used.
+
+        """
+
+        if not self.ccache:
+            return ({}, [])
+        wrappers = [dir for dir in CCACHEWRAPPERS if os.path.isdir(dir)]
+        if not wrappers:
+            raise FedpkgError('ccache does not seem to be installed')
+        ccachedir = os.path.join(CCACHEDIR, self.module, self.branch)
+        if not os.path.isdir(ccachedir):
+            os.makedirs(ccachedir)
+        env = {'CCACHE_DIR': ccachedir,
+               # Hash paths relative to the module so the per arch build
+               # directories share results
+               'CCACHE_BASEDIR': self.path,
+               'PATH': '%s:%s' % (wrappers[0], os.environ.get('PATH', ''))}
+        for cmd in (['ccache', '-M', CCACHEMAXSIZE], ['ccache', '-z']):
+            try:
+                subprocess.Popen(cmd, env=dict(os.environ, **env),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE).communicate()
+            except OSError, e:
+                raise FedpkgError('Could not run ccache: %s' % e)
+        log.info('Using the compiler cache in %s' % ccachedir)
+        return (env, ["--define '__cc ccache gcc'",
+                      "--define '__cxx ccache g++'"])
+
+    def _ccache_report(self, env):
+        """Log the hit rate of the compiler cache since _ccache_start"""
+
+        if not env:
+            return
+        try:
+            proc = subprocess.Popen(['ccache', '--print-stats'],
+                                    env=dict(os.environ, **env),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output = proc.communicate()[0]
+            if proc.returncode:
+                # Older ccache only has the human readable form
+                proc = subprocess.Popen(['ccache', '-s'],
+                                        env=dict(os.environ, **env),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                output = proc.communicate()[0]
+        except OSError, e:
+            log.debug('Could not get ccache statistics: %s' % e)
+            return
+        hits = misses = 0
+        for line in output.split('\n'):
+            fields = line.split()
+            if not fields or not fields[-1].isdigit():
+                continue
+            name = ' '.join(fields[:-1])
+            if name in ('direct_cache_hit', 'preprocessed_cache_hit',
+                        'cache hit (direct)', 'cache hit (preprocessed)'):
+                hits += int(fields[-1])
+            elif name in ('cache_miss', 'cache miss'):
+                misses += int(fields[-1])
+        if hits + misses:
+            log.info('Compiler cache: %s hits, %s misses (%.0f%% hit rate)' %
+                     (hits, misses, 100.0 * hits / (hits + misses)))
+        else:
+            log.info('Compiler cache: nothing was compiled')
 
     def __init__(self, path=os.getcwd()):
         # Initiate a PackageModule object in a given path
-        # Set some global variables used throughout
+        # Set some global variables used throughout.  The expensive ones
+        # (spec, module, specfile, localarch, mockconfig, rpmmacros,
+        # rpmdefines, specinfo, ver, rel and repo) are computed when first
+        # used, see _lazy.
         log.debug('Creating module object from %s' % path)
         self.path = path
         self.lookaside = LOOKASIDE
+        self.lookaside_cgi = LOOKASIDE_CGI
         self.lookasidehash = LOOKASIDEHASH
-        self.spec = self.gimmespec()
-        self.module = self.spec.split('.spec')[0]
-        self.localarch = self._getlocalarch()
-        # Set the default mock config to None, not all branches have a config
-        self.mockconfig = None
+        self.extrahashes = LOOKASIDEEXTRAHASHES
+        self.cache = SourceCache()
+        self.verifyindex = VerifyIndex()
+        # Set to True to hash every source file again instead of trusting
+        # the verify index
+        self.paranoid = False
+        # Set to True to build locally with a compiler cache
+        self.ccache = CCACHE
         # Set a place holder for kojisession
         self.kojisession = None
         # Find the branch and set things based from that
@@ -647,13 +2722,11 @@ class PackageModule:
             self.distvar = 'fedora'
             self.dist = '.fc%s' % self.distval
             self.target = 'dist-f%s-updates-candidate' % self.distval
-            self.mockconfig = 'fedora-%s-%s' % (self.distval, self.localarch)
         elif self.branch.startswith('EL-'):
             self.distval = self.branch.split('-')[1]
             self.distvar = 'epel'
             self.dist = '.el%s' % self.distval
             self.target = 'dist-%sE-epel-testing-candidate' % self.distval
-            self.mockconfig = 'epel-%s-%s' % (self.distval, self.localarch)
         elif self.branch.startswith('OLPC-'):
             self.distval = self.branch.split('-')[1]
             self.distvar = 'olpc'
@@ -665,21 +2738,6 @@ class PackageModule:
             self.distvar = 'fedora'
             self.dist = '.fc%s' % self.distval
             self.target = 'dist-f%s' % self.distval # will be dist-rawhide
-            self.mockconfig = 'fedora-devel-%s' % self.localarch
-        self.rpmdefines = ["--define '_sourcedir %s'" % path,
-                           "--define '_specdir %s'" % path,
-                           "--define '_builddir %s'" % path,
-                           "--define '_srcrpmdir %s'" % path,
-                           "--define '_rpmdir %s'" % path,
-                           "--define 'dist %s'" % self.dist,
-                           "--define '%s %s'" % (self.distvar, self.distval),
-                           "--define '%s 1'" % self.distvar]
-        self.ver = self.getver()
-        self.rel = self.getrel()
-        try:
-            self.repo = git.Repo(path)
-        except git.errors.InvalidGitRepositoryError:
-            raise FedpkgError('%s is not a valid repo' % path)
 
     def build(self, skip_tag=False, scratch=False, background=False,
               url=None, chain=None):
@@ -795,21 +2853,18 @@ class PackageModule:
         # already and it would be redundant.
 
         cloglines = []
-        spec = open(os.path.join(self.path, self.spec), 'r').readlines()
-        for line in spec:
-            if line.startswith('%changelog'):
-                # Grab all the lines below changelog
-                for line2 in spec[spec.index(line):]:
-                    if line2.startswith('\n'):
-                        break
-                    if line2.startswith('$'):
-                        continue
-                    if line2.startswith('%'):
-                        continue
-                    cloglines.append(line2.replace('%%', '%'))
+        for line in self.specfile.section('changelog'):
+            if line.startswith('\n'):
+                break
+            if line.startswith('$'):
+                continue
+            if line.startswith('%'):
+                continue
+            cloglines.append(line.replace('%%', '%'))
         # Now open the clog file and write out the lines
         clogfile = open(os.path.join(self.path, 'clog'), 'w')
         clogfile.writelines(cloglines)
+        clogfile.close()
         return
 
     def commit(self, message=None, file=None, files=[]):
@@ -847,27 +2902,182 @@ class PackageModule:
         _run_command(cmd)
         return
 
-    def compile(self, arch=None, short=False):
-        """Run rpm -bc on a module
+    def _stage_fingerprints(self, arch):
+        """Work out what each rpmbuild stage depends on for arch
 
-        optionally for a specific arch, or short-circuit it
+        The fingerprint of a stage covers the spec preamble and the spec
+        sections of that stage and the ones before it, the checksums of the
+        sources and patches, our rpmdefines and the arch.  If it hasn't
+        changed since the stage last ran, that stage doesn't need to run
+        again.
 
-        Logs the output and returns nothing
+        Returns a dict of stage name to fingerprint.
+
+        """
+
+        sum = hashlib.sha1()
+        sum.update(self.specfile.text('preamble'))
+        sum.update('\0'.join(self.rpmdefines + [arch]))
+        # Sources in the lookaside already have a checksum we can use
+        checksums = {}
+        for line in open(os.path.join(self.path, 'sources'), 'r').readlines():
+            try:
+                (csum, file) = line.split('  ', 1)
+                checksums[file.strip()] = csum
+            except ValueError:
+                continue
+        for source in self.specinfo['sources']:
+            file = os.path.basename(source[0])
+            if file not in checksums and \
+               os.path.exists(os.path.join(self.path, file)):
+                checksums[file] = _hash_file(os.path.join(self.path, file),
+                                             self.lookasidehash)
+        for file in sorted(checksums.keys()):
+            sum.update('%s %s\0' % (file, checksums[file]))
+        fingerprints = {}
+        for stage in BUILDSTAGES:
+            sum.update(self.specfile.text(stage))
+            fingerprints[stage] = sum.hexdigest()
+        return fingerprints
+
+    def _stages_file(self):
+        """Return where we record the stages done, or None if we can't"""
+
+        gitdir = os.path.join(self.path, '.git')
+        if not os.path.isdir(gitdir):
+            return None
+        return os.path.join(gitdir, STAGESFILE)
+
+    def _read_stages(self):
+        """Return a dict of (stage, arch) to the fingerprint used for it"""
+
+        stages = {}
+        stagesfile = self._stages_file()
+        if not stagesfile:
+            return stages
+        try:
+            record = open(stagesfile, 'r')
+        except IOError:
+            return stages
+        for line in record.readlines():
+            try:
+                (stage, arch, fingerprint) = line.split()
+                stages[(stage, arch)] = fingerprint
+            except ValueError:
+                continue
+        record.close()
+        return stages
+
+    def _record_stages(self, arch, upto, fingerprints):
+        """Record that the stages up to upto are done for arch
+
+        The later stages are forgotten, since they have to run again on
+        top of what was just done.  Errors are only logged, the record is
+        just a shortcut.
+
+        """
+
+        stagesfile = self._stages_file()
+        if not stagesfile:
+            return
+        stages = self._read_stages()
+        last = BUILDSTAGES.index(upto)
+        for stage in BUILDSTAGES:
+            if BUILDSTAGES.index(stage) <= last:
+                stages[(stage, arch)] = fingerprints[stage]
+            elif (stage, arch) in stages:
+                del stages[(stage, arch)]
+        try:
+            record = open(stagesfile, 'w')
+            for (stage, arch), fingerprint in sorted(stages.items()):
+                record.write('%s %s %s\n' % (stage, arch, fingerprint))
+            record.close()
+        except IOError, e:
+            log.debug('Could not write %s: %s' % (stagesfile, e))
+
+    def _first_stage(self, arch, fingerprints):
+        """Return the earliest stage for arch whose inputs have changed
+
+        The record is no good once the tree %prep made is gone, so then
+        it is prep.  Returns None if every stage is still up to date.
+
+        """
+
+        subdir = self.specfile.buildsubdir()
+        builddir = dict(self.rpmmacros).get('_builddir', self.path)
+        if subdir and not os.path.isdir(os.path.join(builddir, subdir)):
+            return 'prep'
+        stages = self._read_stages()
+        for stage in BUILDSTAGES:
+            if stages.get((stage, arch)) != fingerprints[stage]:
+                return stage
+        return None
+
+    def _run_stages(self, upto, arch=None, short=None):
+        """Run rpmbuild up to the stage upto, build or install
+
+        short says whether to pass --short-circuit.  When it is None the
+        earliest stage whose inputs changed since it last ran is found, and
+        each stage from there on is run by itself, short-circuiting past
+        the ones before it.  That way every stage that works is recorded,
+        even when a later one fails.
 
         """
 
         # Get the sources
         self.sources()
-        # setup the rpm command
-        cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        if arch:
-            cmd.extend(['--target', arch])
-        if short:
-            cmd.append('--short-circuit')
-        cmd.extend(['-bc', os.path.join(self.path, self.spec)])
-        # Run the command
-        _run_command(cmd, shell=True)
+        target = arch or self.localarch
+        fingerprints = self._stage_fingerprints(target)
+        opts = {'prep': '-bp', 'build': '-bc', 'install': '-bi'}
+        forced = short
+        if short is None:
+            first = self._first_stage(target, fingerprints)
+            if first is None or \
+               BUILDSTAGES.index(first) > BUILDSTAGES.index(upto):
+                # Everything we asked for is done, but do the last stage
+                # again as it was asked for
+                first = upto
+            # Short-circuit straight to the first stage to do, then each
+            # stage after it in turn.  Only %prep can't be short-circuited.
+            runs = [(stage, stage != 'prep') for stage in
+                    BUILDSTAGES[BUILDSTAGES.index(first):
+                                BUILDSTAGES.index(upto) + 1]]
+            if first != 'prep':
+                log.info('Earlier stages are up to date for %s, '
+                         'short-circuiting to %%%s' % (target, first))
+        else:
+            runs = [(upto, short)]
+        (env, defines) = self._ccache_start()
+        for (stage, short) in runs:
+            # setup the rpm command
+            cmd = ['rpmbuild']
+            cmd.extend(self.rpmdefines)
+            cmd.extend(defines)
+            if arch:
+                cmd.extend(['--target', arch])
+            if short:
+                cmd.append('--short-circuit')
+            cmd.extend([opts[stage], os.path.join(self.path, self.spec)])
+            # Run the command
+            _run_command(cmd, shell=True, env=env)
+            # When told to short-circuit we can't know the earlier stages
+            # are current, so leave the record alone
+            if not forced:
+                self._record_stages(target, stage, fingerprints)
+        self._ccache_report(env)
+
+    def compile(self, arch=None, short=None):
+        """Run rpm -bc on a module
+
+        optionally for a specific arch, or short-circuit it.  If short is
+        not given, %prep is skipped when nothing it depends on has changed
+        since it last ran.
+
+        Logs the output and returns nothing
+
+        """
+
+        self._run_stages('build', arch, short)
         return
 
     def diff(self, cached=False, files=[]):
@@ -900,51 +3110,19 @@ class PackageModule:
         return
 
     def getver(self):
-        """Return the version-release of a package module."""
+        """Return the version of a package module."""
 
-        cmd = ['rpm']
-        cmd.extend(self.rpmdefines)
-        # We make sure there is a space at the end of our query so that
-        # we can split it later.  When ther eare sub packages, we get a
-        # listing for each subpackage.  We only care about the first.
-        cmd.extend(['-q', '--qf', '"%{VERSION} "', '--specfile',
-                    os.path.join(self.path, self.spec)])
-        try:
-            output = subprocess.Popen(' '.join(cmd), shell=True,
-                                      stdout=subprocess.PIPE).communicate()
-        except subprocess.CalledProcessError, e:
-            raise FedpkgError('Could not get version of %s: %s' % (self.module, e))
-        # Get just the output, then split it by space, grab the first
-        return output[0].split()[0]
+        return self._parse_spec()['version']
 
     def getrel(self):
-        """Return the version-release of a package module."""
+        """Return the release of a package module."""
 
-        cmd = ['rpm']
-        cmd.extend(self.rpmdefines)
-        # We make sure there is a space at the end of our query so that
-        # we can split it later.  When ther eare sub packages, we get a
-        # listing for each subpackage.  We only care about the first.
-        cmd.extend(['-q', '--qf', '"%{RELEASE} "', '--specfile',
-                    os.path.join(self.path, self.spec)])
-        try:
-            output = subprocess.Popen(' '.join(cmd), shell=True,
-                                      stdout=subprocess.PIPE).communicate()
-        except subprocess.CalledProcessError, e:
-            raise FedpkgError('Could not get release of %s: %s' % (self.module, e))
-        # Get just the output, then split it by space, grab the first
-        return output[0].split()[0]
+        return self._parse_spec()['release']
 
     def gimmespec(self):
         """Return the name of a specfile within a package module"""
-    
-        # Get a list of files in the path we're looking at
-        files = os.listdir(self.path)
-        # Search the files for the first one that ends with ".spec"
-        for f in files:
-            if f.endswith('.spec'):
-                return f
-        raise FedpkgError('No spec file found.')
+
+        return self.spec
 
     def koji_upload(self, file, path, callback=None):
         """Upload a file to koji
@@ -1029,33 +3207,57 @@ class PackageModule:
             raise FedpkgError('Could not auth with koji as %s' % user)
         return
 
-    def install(self, arch=None, short=False):
+    def install(self, arch=None, short=None):
         """Run rpm -bi on a module
 
-        optionally for a specific arch, or short-circuit it
+        optionally for a specific arch, or short-circuit it.  If short is
+        not given, rpmbuild starts from the first of %prep and %build whose
+        inputs have changed since it last ran.
 
         Logs the output and returns nothing
 
         """
 
-        # Get the sources
-        self.sources()
-        # setup the rpm command
-        cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        if arch:
-            cmd.extend(['--target', arch])
-        if short:
-            cmd.append('--short-circuit')
-        cmd.extend(['-bi', os.path.join(self.path, self.spec)])
-        # Run the command
-        _run_command(cmd, shell=True)
+        self._run_stages('install', arch, short)
         return
 
+    def _lint_key(self):
+        """Return a hash of the rpmlint version and configuration in use"""
+
+        sum = hashlib.sha1()
+        try:
+            proc = subprocess.Popen(['rpmlint', '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            sum.update(proc.communicate()[0])
+        except OSError, e:
+            raise FedpkgError('Could not run rpmlint: %s' % e)
+        configs = [os.path.expanduser('~/.rpmlintrc'),
+                   os.path.expanduser('~/.config/rpmlint')]
+        if os.path.isdir('/etc/rpmlint'):
+            configs.extend([os.path.join('/etc/rpmlint', file) for file in
+                            sorted(os.listdir('/etc/rpmlint'))])
+        # rpmlint picks up a package's own filters too
+        configs.extend([os.path.join(self.path, file) for file in
+                        sorted(os.listdir(self.path))
+                        if file.endswith('rpmlintrc')])
+        for config in configs:
+            if not os.path.isfile(config):
+                continue
+            sum.update('%s\0' % config)
+            sum.update(open(config, 'rb').read())
+        return sum.hexdigest()
+
     def lint(self):
         """Run rpmlint over a built srpm
 
-        Log the output and returns nothing
+        Each rpm is linted on its own, several at a time, and the results
+        are cached in LINTCACHE keyed by the rpm's checksum and the rpmlint
+        version and configuration, so unchanged rpms aren't linted again.
+        The output is logged in a stable order, the srpm first and then the
+        rpms of each arch by name.
+
+        Log the output and raises if rpmlint found errors
 
         """
 
@@ -1066,17 +3268,133 @@ class PackageModule:
         # Get the possible built arches
         arches = _get_build_arches_from_srpm(os.path.join(self.path, srpm),
                                              [self.localarch])
-        rpms = []
+        rpms = [os.path.join(self.path, srpm)]
         for arch in arches:
             rpms.extend([os.path.join(self.path, arch, file) for file in
-                         os.listdir(os.path.join(self.path, arch))
+                         sorted(os.listdir(os.path.join(self.path, arch)))
                          if file.endswith('.rpm')])
-        cmd = ['rpmlint', os.path.join(self.path, srpm)]
-        cmd.extend(rpms)
-        # Run the command
-        _run_command(cmd, shell=True)
+        lintkey = self._lint_key()
+
+        def cachefile(rpmfile):
+            sum = self.verifyindex.lookup(rpmfile, 'sha256')
+            if not sum:
+                sum = _hash_file(rpmfile, 'sha256')
+                self.verifyindex.record(rpmfile, 'sha256', sum)
+            return os.path.join(LINTCACHE, hashlib.sha1('%s %s' % (sum,
+                                lintkey)).hexdigest())
+
+        def check(rpmfile):
+            cached = cachefile(rpmfile)
+            try:
+                result = open(cached, 'r')
+                returncode = int(result.readline())
+                output = result.read()
+                result.close()
+                log.debug('Using cached rpmlint output for %s' % rpmfile)
+                return (returncode, output)
+            except (IOError, ValueError):
+                pass
+            cmd = ['rpmlint', rpmfile]
+            log.debug('Running: %s' % subprocess.list2cmdline(cmd))
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+            except OSError, e:
+                raise FedpkgError('Could not run rpmlint: %s' % e)
+            # Anything else means rpmlint itself had trouble
+            if proc.returncode in (0, 64, 66):
+                try:
+                    if not os.path.isdir(LINTCACHE):
+                        os.makedirs(LINTCACHE)
+                    (fd, tmpfile) = tempfile.mkstemp(dir=LINTCACHE)
+                    result = os.fdopen(fd, 'w')
+                    result.write('%s\n%s' % (proc.returncode, output))
+                    result.close()
+                    os.rename(tmpfile, cached)
+                except (IOError, OSError), e:
+                    log.debug('Could not cache rpmlint output: %s' % e)
+            return (proc.returncode, output)
+
+        results = _run_parallel(check, rpms)
+        self.verifyindex.write()
+        # Each run ends with its own summary, add them up into one
+        summary = re.compile('^(\d+) packages? and \d+ specfiles? checked; '
+                             '(\d+) errors?, (\d+) warnings?')
+        errors = warnings = 0
+        failed = False
+        for (rpmfile, (result, error)) in zip(rpms, results):
+            if error:
+                raise error
+            (returncode, output) = result
+            if returncode:
+                failed = True
+            for line in output.splitlines():
+                match = summary.match(line)
+                if match:
+                    errors += int(match.group(2))
+                    warnings += int(match.group(3))
+                elif line:
+                    log.info(line)
+        log.info('%s packages and 0 specfiles checked; %s errors, %s warnings.'
+                 % (len(rpms), errors, warnings))
+        if failed:
+            raise FedpkgError('rpmlint found problems')
         return
 
+    def _local_command(self, arch, hashtype='sha256', builddir=None,
+                       smpflags=None, binaryonly=False, rpmdir=None):
+        """Return the rpmbuild command to build the module for arch
+
+        builddir and rpmdir replace the module as the _builddir and the
+        _rpmdir, smpflags replaces the _smp_mflags rpm would use and
+        binaryonly builds just the binary packages.
+
+        """
+
+        cmd = ['rpmbuild']
+        dirs = {}
+        if builddir:
+            dirs['_builddir'] = builddir
+        if rpmdir:
+            dirs['_rpmdir'] = rpmdir
+        cmd.extend(["--define '%s %s'" % (name, value) for (name, value)
+                    in self.rpmmacros if name not in dirs])
+        for name in sorted(dirs.keys()):
+            cmd.append("--define '%s %s'" % (name, dirs[name]))
+        if smpflags:
+            cmd.append("--define '_smp_mflags %s'" % smpflags)
+        # This may need to get updated if we ever change our checksum default
+        if not hashtype == 'sha256':
+            cmd.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
+                        "--define '_binary_filedigest_algorithm %s'" % hashtype])
+        if binaryonly:
+            cmd.extend(['--target', arch, '-bb'])
+        else:
+            cmd.extend(['--target', arch, '-ba'])
+        cmd.append(os.path.join(self.path, self.spec))
+        return cmd
+
+    def _build_logged(self, cmd, logfile, prefix='', echo=True, env={}):
+        """Run a build command, writing its output to logfile
+
+        The output is logged as it arrives, see _tee_command.  If the build
+        fails the last lines of its output are logged again at the end.
+
+        Returns the returncode from the build call
+
+        """
+
+        log.debug('Running: %s' % ' '.join(cmd))
+        (returncode, tail, cpu) = _tee_command(' '.join(cmd), logfile,
+                                               shell=True,
+                                               env=dict(os.environ, **env),
+                                               prefix=prefix, echo=echo)
+        if returncode:
+            log.error('%sBuild failed, the output ended with:\n%s' %
+                      (prefix, '\n'.join(tail)))
+        return returncode
+
     def local(self, arch=None, hashtype='sha256'):
         """rpmbuild locally for given arch.
 
@@ -1088,38 +3406,90 @@ class PackageModule:
 
         """
 
-        # This could really use a list of arches to build for and loop over
         # Get the sources
         self.sources()
         # Determine arch to build for
         if not arch:
             arch = self.localarch
         # build up the rpm command
-        cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        # This may need to get updated if we ever change our checksum default
-        if not hashtype == 'sha256':
-            cmd.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
-                        "--define '_binary_filedigest_algorithm %s'" % hashtype])
-        cmd.extend(['--target', arch, '-ba',
-                    os.path.join(self.path, self.spec)])
+        (env, defines) = self._ccache_start()
+        cmd = self._local_command(arch, hashtype)
+        cmd[1:1] = defines
+        fingerprints = self._stage_fingerprints(arch)
         # Run the command
-        log.debug('Running: %s' % ' '.join(cmd))
-        try:
-            proc = subprocess.Popen(' '.join(cmd), stderr=subprocess.PIPE,
-                                    stdout=subprocess.PIPE, shell=True)
-            output, error = proc.communicate()
-        except OSError, e:
-            raise FedpkgError(e)
-        outfile = open(os.path.join(self.path, '.build-%s-%s.log' % (self.ver,
-                       self.rel)), 'w')
-        outfile.writelines(output)
-        log.info(output)
-        if error:
-            outfile.writelines(error)
-            log.error(error)
-        outfile.close()
-        return proc.returncode
+        returncode = self._build_logged(cmd, os.path.join(self.path,
+                                        '.build-%s-%s.log' % (self.ver,
+                                                              self.rel)),
+                                        env=env)
+        self._ccache_report(env)
+        if not returncode:
+            # %clean throws away the buildroot, but the build tree stays
+            self._record_stages(arch, 'build', fingerprints)
+        return returncode
+
+    def local_arches(self, arches=None, hashtype='sha256'):
+        """rpmbuild locally for several arches at the same time.
+
+        arches is the list of arches to build for.  If it is not given every
+        arch rpmbuild can build for here (see LOCALARCHES) that the spec
+        allows is used.  hashtype is the hash type to build with.
+
+        Each arch is built by its own rpmbuild in .build-ARCH, with the
+        available cpus shared out between them through _smp_mflags, and
+        writes its own .build-VER-REL.ARCH.log.  The packages end up under
+        .build-ARCH too, as noarch subpackages come out of every build and
+        the builds must not write over each other.  Only the first arch
+        builds the srpm as well.
+
+        Returns a list of (arch, returncode, logfile) tuples in arch order.
+
+        """
+
+        # Get the sources
+        self.sources()
+        if not arches:
+            arches = _filter_build_arches(LOCALARCHES.get(self.localarch,
+                                                          [self.localarch]),
+                                          self.specinfo['buildarchs'],
+                                          self.specinfo['exclusivearch'],
+                                          self.specinfo['excludearch'])
+            if not arches:
+                raise FedpkgError('No arches %s can be built for here' %
+                                  self.module)
+        jobs = max(1, _cpu_count() / len(arches))
+        (env, defines) = self._ccache_start()
+        builds = []
+        for arch in arches:
+            builddir = os.path.join(self.path, '.build-%s' % arch)
+            cmd = self._local_command(arch, hashtype, builddir=builddir,
+                                      smpflags='-j%s' % jobs,
+                                      binaryonly=bool(builds),
+                                      rpmdir=builddir)
+            cmd[1:1] = defines
+            logfile = os.path.join(self.path, '.build-%s-%s.%s.log' %
+                                   (self.ver, self.rel, arch))
+            builds.append((arch, cmd, logfile))
+
+        def build(item):
+            (arch, cmd, logfile) = item
+            log.info('Building %s for %s, logging to %s' %
+                     (self.module, arch, logfile))
+            if not os.path.isdir(os.path.join(self.path, '.build-%s' % arch)):
+                os.makedirs(os.path.join(self.path, '.build-%s' % arch))
+            # With several builds at once the output would be a jumble, so
+            # it only goes to the log files and the logger's debug level
+            return self._build_logged(cmd, logfile, prefix='%s: ' % arch,
+                                      echo=False, env=env)
+
+        results = []
+        for (item, (returncode, error)) in zip(builds, _run_parallel(build,
+                                               builds, workers=len(builds))):
+            if error:
+                log.error('Could not build for %s: %s' % (item[0], error))
+                returncode = 1
+            results.append((item[0], returncode, item[2]))
+        self._ccache_report(env)
+        return results
 
     def mockbuild(self, mockargs=[]):
         """Build the package in mock, using mockargs
@@ -1145,16 +3515,184 @@ class PackageModule:
         _run_command(cmd)
         return
 
-    def upload(self, files, replace=False):
+    def branch_mockconfigs(self):
+        """Return the mock configs for all the branches of the module
+
+        Every branch the remote has gets a config for each arch we can
+        build for here, as long as mock has that config installed.
+
+        """
+
+        configs = []
+        for branch in self.repo.git.branch('-r').split('\n'):
+            branch = branch.strip().split(' ')[0].split('/')[-1]
+            if not branch:
+                continue
+            for arch in LOCALARCHES.get(self.localarch, [self.localarch]):
+                config = _branch_mockconfig(branch, arch)
+                if not config or config in configs:
+                    continue
+                if not os.path.exists(os.path.join(MOCKCONFIGDIR,
+                                                   '%s.cfg' % config)):
+                    log.debug('Skipping %s, mock has no config for it' %
+                              config)
+                    continue
+                configs.append(config)
+        return configs
+
+    def _mock_can_start(self, running):
+        """Return whether there are resources for one more mock build"""
+
+        if running >= MOCKMAXJOBS:
+            return False
+        # Always let one through, or nothing would ever get built
+        if not running:
+            return True
+        if running >= _cpu_count():
+            return False
+        free = _free_memory()
+        if free is not None and free < MOCKMEMORY:
+            return False
+        try:
+            if os.getloadavg()[0] > _cpu_count() - 0.5:
+                return False
+        except OSError:
+            pass
+        return True
+
+    def mockbuild_configs(self, configs=None, mockargs=[], callback=None):
+        """Build the package in mock for several configs at the same time
+
+        configs is the list of mock configs to build with, defaults to all
+        the branches of the module (see branch_mockconfigs).  mockargs are
+        extra arguments for every mock run.
+
+        A new build is only started when there is a chroot slot left (see
+        MOCKMAXJOBS), a cpu to spare and enough free memory.  The results
+        of each config go to module/ver/rel/config, along with the output
+        of mock in mock.log.
+
+        callback is called with a list of (config, state, seconds) tuples
+        whenever something changes and about once a second while builds
+        run.  state is one of waiting, building, done or failed.
+
+        Returns a list of (config, returncode, resultdir) tuples in config
+        order.
+
+        """
+
+        # Make sure we have an srpm to run on
+        srpm = os.path.join(self.path,
+                            "%s-%s-%s.src.rpm" % (self.module,
+                                                  self.ver, self.rel))
+        if not os.path.exists(srpm):
+            raise FedpkgError('Need to build srpm first')
+        if not configs:
+            configs = self.branch_mockconfigs()
+            if not configs:
+                raise FedpkgError('No mock configs found for %s' % self.module)
+
+        resultdirs = [os.path.join(self.path, self.module, self.ver, self.rel,
+                                   config) for config in configs]
+        waiting = range(len(configs))
+        running = {}
+        states = ['waiting'] * len(configs)
+        started = [None] * len(configs)
+        finished = [None] * len(configs)
+        returncodes = [None] * len(configs)
+
+        def report():
+            if not callback:
+                return
+            now = time.time()
+            status = []
+            for i in range(len(configs)):
+                seconds = 0
+                if started[i]:
+                    seconds = (finished[i] or now) - started[i]
+                status.append((configs[i], states[i], seconds))
+            callback(status)
+
+        try:
+            while waiting or running:
+                while waiting and self._mock_can_start(len(running)):
+                    i = waiting.pop(0)
+                    if not os.path.isdir(resultdirs[i]):
+                        os.makedirs(resultdirs[i])
+                    cmd = ['mock']
+                    cmd.extend(mockargs)
+                    cmd.extend(['-r', configs[i], '--resultdir', resultdirs[i],
+                                '--rebuild', srpm])
+                    log.debug('Running: %s' % subprocess.list2cmdline(cmd))
+                    output = open(os.path.join(resultdirs[i], 'mock.log'), 'w')
+                    try:
+                        try:
+                            proc = subprocess.Popen(cmd, stdout=output,
+                                                    stderr=subprocess.STDOUT)
+                        except OSError, e:
+                            raise FedpkgError(e)
+                    finally:
+                        output.close()
+                    running[i] = proc
+                    states[i] = 'building'
+                    started[i] = time.time()
+                for i in running.keys():
+                    if running[i].poll() is None:
+                        continue
+                    returncodes[i] = running[i].returncode
+                    finished[i] = time.time()
+                    if returncodes[i]:
+                        states[i] = 'failed'
+                    else:
+                        states[i] = 'done'
+                    del running[i]
+                report()
+                if running:
+                    time.sleep(1)
+        finally:
+            # Don't leave builds behind if we are interrupted
+            for proc in running.values():
+                try:
+                    proc.terminate()
+                except OSError:
+                    pass
+        return zip(configs, returncodes, resultdirs)
+
+    def upload(self, files, replace=False, callback=None):
         """Upload source file(s) in the lookaside cache
 
         Can optionally replace the existing tracked sources
 
+        callback is an optional progress callback for all the uploads
+        combined, see Lookaside.upload_files
+
+        The files are hashed in parallel, checked against the lookaside in
+        one batch, and the missing ones uploaded at the same time.  The
+        sources and .gitignore entries keep the order the files were given.
+
         """
 
         oldpath = os.getcwd()
         os.chdir(self.path)
 
+        # Hash everything first, hashlib lets go of the GIL while it works
+        hashtypes = [self.lookasidehash]
+        hashtypes.extend([h for h in self.extrahashes if h != hashtypes[0]])
+        results = _run_parallel(lambda f: _hash_file_digests(f, hashtypes),
+                                files)
+        errors = ['%s: %s' % (f, error) for (f, (digests, error)) in
+                  zip(files, results) if error]
+        if errors:
+            os.chdir(oldpath)
+            raise FedpkgError('Could not hash:\n%s' % '\n'.join(errors))
+        # Remember them so sources() doesn't have to hash them again
+        hashes = []
+        for f, (digests, error) in zip(files, results):
+            for hashtype, digest in digests.items():
+                self.verifyindex.record(f, hashtype, digest)
+            hashes.append(digests[self.lookasidehash])
+        self.verifyindex.write()
+
         # Decide to overwrite or append to sources:
         if replace:
             sources = []
@@ -1166,10 +3704,9 @@ class PackageModule:
         # Will add new sources to .gitignore if they are not already there.
         gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
 
-        lookaside = Lookaside()
-        for f in files:
+        uploads = []
+        for f, file_hash in zip(files, hashes):
             # TODO: Skip empty file needed?
-            file_hash = _hash_file(f, self.lookasidehash)
             log.info("Uploading: %s  %s" % (file_hash, f))
             file_basename = os.path.basename(f)
             if not "%s  %s\n" % (file_hash, file_basename) in sources:
@@ -1177,27 +3714,31 @@ class PackageModule:
 
             # Add this file to .gitignore if it's not already there:
             gitignore.add(file_basename)
+            uploads.append((f, file_basename, file_hash))
 
-            if lookaside.file_exists(self.module, file_basename, file_hash):
-                # Already uploaded, skip it:
-                log.info("File already uploaded: %s" % file_basename)
-            else:
+        sources_file.close()
+
+        # Check for all the files at once, then upload the missing ones
+        # together over the same connections.
+        lookaside = Lookaside(self.lookaside_cgi)
+        try:
+            checks = [(self.module, file_basename, file_hash) for
+                      (f, file_basename, file_hash) in uploads]
+            uploaded = lookaside.files_exist(checks)
+            missing = []
+            for (f, file_basename, file_hash), exists in zip(uploads,
+                                                             uploaded):
+                if exists:
+                    # Already uploaded, skip it:
+                    log.info("File already uploaded: %s" % file_basename)
+                    continue
                 # Ensure the new file is readable:
                 os.chmod(f, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-                #lookaside.upload_file(self.module, f, file_hash)
-                # For now don't use the pycurl upload function as it does
-                # not produce any progress output.  Cheat and use curl
-                # directly.
-                # This command is stolen from the dist-cvs make file
-                # It assumes and hard codes the cert file name/location
-                cmd = ['curl', '-k', '--cert',
-                       os.path.expanduser('~/.fedora.cert'), '--fail', '-o',
-                       '/dev/null', '--show-error', '--progress-bar', '-F',
-                       'name=%s' % self.module, '-F', 'md5sum=%s' % file_hash,
-                       '-F', 'file=@%s' % f, LOOKASIDE_CGI]
-                _run_command(cmd)
-
-        sources_file.close()
+                missing.append((self.module, f, file_hash))
+            if missing:
+                lookaside.upload_files(missing, callback=callback)
+        finally:
+            lookaside.close()
 
         # Write .gitignore with the new sources if anything changed:
         gitignore.write()
@@ -1226,62 +3767,59 @@ class PackageModule:
         if arch:
             cmd.extend(['--target', arch])
         cmd.extend(['--nodeps', '-bp', os.path.join(self.path, self.spec)])
-        # Run the command and capture output
+        # Run the command and log the output as it comes
         log.debug('Running: %s' % ' '.join(cmd))
-        try:
-            proc = subprocess.Popen(' '.join(cmd), stderr=subprocess.PIPE,
-                                    stdout=subprocess.PIPE, shell=True)
-            output, error = proc.communicate()
-        except OSError, e:
-            raise FedpkgError(e)
-        log.info(output)
-        if error:
-            log.error(error)
-        return proc.returncode
+        fingerprints = self._stage_fingerprints(arch or self.localarch)
+        returncode = _tee_command(' '.join(cmd), shell=True)[0]
+        if not returncode:
+            self._record_stages(arch or self.localarch, 'prep', fingerprints)
+        return returncode
                
-    def sources(self, outdir=None):
-        """Download source files"""
-    
+    def sources(self, outdir=None, callback=None):
+        """Download source files
+
+        outdir is the directory to put the files in, defaults to the module
+
+        callback is an optional progress callback, see _download_files
+
+        Files that have not changed since they were last verified are not
+        hashed again, unless paranoid is set.  Files already in the shared
+        source cache are taken from there, all the others are downloaded at
+        the same time and then added to the cache.  Raises if any of them
+        could not be downloaded or failed checksum.
+
+        """
+
         archives = open(os.path.join(self.path, 'sources'),
                         'r').readlines()
         # Default to putting the files where the module is
         if not outdir:
             outdir = self.path
-        for archive in archives:
-            csum, file = archive.split()
-            # See if we already have a valid copy downloaded
-            outfile = os.path.join(outdir, file)
-            if os.path.exists(outfile):
-                if _verify_file(outfile, csum, self.lookasidehash):
-                    continue
-            url = '%s/%s/%s/%s/%s' % (self.lookaside, self.module, file, csum,
-                                      file)
-            # There is some code here for using pycurl, but for now,
-            # just use subprocess
-            #output = open(file, 'wb')
-            #curl = pycurl.Curl()
-            #curl.setopt(pycurl.URL, url)
-            #curl.setopt(pycurl.FOLLOWLOCATION, 1)
-            #curl.setopt(pycurl.MAXREDIRS, 5)
-            #curl.setopt(pycurl.CONNECTTIMEOUT, 30)
-            #curl.setopt(pycurl.TIMEOUT, 300)
-            #curl.setopt(pycurl.WRITEDATA, output)
-            #try:
-            #    curl.perform()
-            #except:
-            #    print "Problems downloading %s" % url
-            #    curl.close()
-            #    output.close()
-            #    return 1
-            #curl.close()
-            #output.close()
-            # These options came from Makefile.common.
-            # Probably need to support wget too
-            command = ['curl', '-H',  'Pragma:', '-O', '-R', '-S',  '--fail',
-                       '--show-error', url]
-            _run_command(command)
-            if not _verify_file(outfile, csum, self.lookasidehash):
-                raise FedpkgError('%s failed checksum' % file)
+        entries = []
+        for number, archive in enumerate(archives):
+            if not archive.strip():
+                continue
+            try:
+                csum, file = archive.split()
+            except ValueError:
+                raise FedpkgError('Bad line %s in the sources file of %s: '
+                                  '%r' % (number + 1, self.module,
+                                          archive.strip()))
+            entries.append((self.module, file, csum,
+                            os.path.join(outdir, file)))
+        (downloaded, reused, failed) = _fetch_sources(entries,
+                                                      self.lookaside,
+                                                      self.lookasidehash,
+                                                      self.cache,
+                                                      self.verifyindex,
+                                                      self.extrahashes,
+                                                      self.paranoid,
+                                                      callback)
+        if failed:
+            raise FedpkgError('Could not download all sources:\n%s' %
+                              '\n'.join(['%s: %s' % (os.path.basename(outfile),
+                                                      error)
+                                          for (outfile, error) in failed]))
         return
 
     def srpm(self, hashtype='sha256'):
@@ -1310,14 +3848,14 @@ class PackageModule:
 
         # Create a list for unused patches
         unused = []
-        # Get the content of spec into memory for fast searching
-        spec = open(self.spec, 'r').read()
+        # A patch is used if it is both a Patch tag and gets applied
+        used = set(self.specfile.applied_patches())
         # Get a list of files tracked in source control
         files = self.repo.git.ls_files('--exclude-standard').split()
         for file in files:
             # throw out non patches
             if not file.endswith('.patch'):
                 continue
-            if file not in spec:
+            if file not in used:
                 unused.append(file)
         return unused